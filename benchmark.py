@@ -0,0 +1,443 @@
+"""
+BENCHMARK.PY
+
+Offline benchmark for the unzip pipeline. It generates synthetic archives, feeds them through the real
+handlers in unzipbot.py and replaces Telegram with an in-process fake that simulates bandwidth, latency
+and flood waits. Nothing talks to the network and no config.py is needed.
+
+Usage:
+    python benchmark.py                          # every scenario, JSON printed to stdout
+    python benchmark.py --scenario zip --output results.json
+    python benchmark.py --compare results.json   # run again and show the change against an earlier run
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import tarfile
+import zipfile
+import platform
+import threading
+import subprocess
+
+import psutil
+import py7zr
+from telethon import types as tl_types
+from telethon.errors import FloodWaitError
+
+BENCHMARK_USER_ID = 4242
+BENCHMARK_PASSWORD = "benchmark"
+
+# The bot reads its settings from config.py. The benchmark supplies its own so results do not depend on the
+# local setup. This runs at import time because the spawned extraction workers import this module as well.
+benchmark_config = types.ModuleType("config")
+benchmark_config.BOT_TOKEN = ""
+benchmark_config.API_ID = 0
+benchmark_config.API_HASH = ""
+benchmark_config.ALLOWED_USERS = [BENCHMARK_USER_ID]
+benchmark_config.FILE_ID_CACHE_SIZE = 0
+benchmark_config.ARCHIVE_CACHE_SIZE = 0
+benchmark_config.MIN_FREE_DISK = 0
+benchmark_config.MIN_FREE_MEMORY = 0
+sys.modules.setdefault("config", benchmark_config)
+
+unzipbot = None  # Imported in main(), once the working directory has been set up
+
+# Archive shapes: (number of files, size of each file in bytes), before --scale
+SHAPES = {
+    "few-large": (4, 16 * 1024 * 1024),
+    "many-tiny": (500, 4 * 1024),
+}
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+
+# ---------------------------------------------------------------------------
+# Corpus generation
+# ---------------------------------------------------------------------------
+
+def file_contents(rng, kind, size):
+    """Random bytes for photos (incompressible, like real JPEGs), random words for documents."""
+    if kind == "photos":
+        return rng.randbytes(size)
+    text = " ".join(rng.choice(WORDS) for _ in range(size // 5 + 1))
+    return text.encode()[:size]
+
+
+def build_corpus(corpus_dir, archive_format, shape, kind, encrypted, scale):
+    """Create (or reuse) a synthetic archive and return its path, or raise RuntimeError if it cannot be made here."""
+    count, size = SHAPES[shape]
+    size = max(1, int(size * scale))
+    name = f"{shape}-{kind}-{'encrypted' if encrypted else 'plain'}-{scale:g}.{archive_format}"
+    archive_path = os.path.join(corpus_dir, name)
+    if os.path.exists(archive_path):
+        return archive_path
+
+    source_dir = os.path.join(corpus_dir, "source-" + name)
+    shutil.rmtree(source_dir, ignore_errors=True)
+    os.makedirs(source_dir)
+    rng = random.Random(f"{shape}-{kind}-{scale}")
+    extension = "jpg" if kind == "photos" else "txt"
+    members = []
+    for i in range(count):
+        member = f"{kind}/{i // 100:02d}/file{i:04d}.{extension}"
+        os.makedirs(os.path.join(source_dir, os.path.dirname(member)), exist_ok=True)
+        with open(os.path.join(source_dir, member), "wb") as member_file:
+            member_file.write(file_contents(rng, kind, size))
+        members.append(member)
+
+    partial_path = archive_path + ".partial"
+    try:
+        if archive_format == "zip" and encrypted:
+            if not shutil.which("zip"):
+                raise RuntimeError("encrypted zip needs the zip command")
+            subprocess.run(["zip", "-q", "-P", BENCHMARK_PASSWORD, os.path.abspath(partial_path), *members], cwd=source_dir, check=True)
+        elif archive_format == "zip":
+            with zipfile.ZipFile(partial_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                for member in members:
+                    archive.write(os.path.join(source_dir, member), member)
+        elif archive_format == "7z":
+            with py7zr.SevenZipFile(partial_path, "w", password=BENCHMARK_PASSWORD if encrypted else None) as archive:
+                for member in members:
+                    archive.write(os.path.join(source_dir, member), member)
+        elif archive_format == "rar":
+            if not shutil.which("rar"):
+                raise RuntimeError("rar archives need the rar command")
+            command = ["rar", "a", "-idq"] + ([f"-p{BENCHMARK_PASSWORD}"] if encrypted else [])
+            subprocess.run(command + [os.path.abspath(partial_path) + ".rar", *members], cwd=source_dir, check=True)
+            os.rename(partial_path + ".rar", partial_path)
+        elif archive_format == "tar.gz":
+            if encrypted:
+                raise RuntimeError("tar.gz has no encryption")
+            with tarfile.open(partial_path, "w:gz") as archive:
+                for member in members:
+                    archive.add(os.path.join(source_dir, member), member)
+        else:
+            raise RuntimeError(f"unknown format {archive_format}")
+        os.rename(partial_path, archive_path)
+    finally:
+        shutil.rmtree(source_dir, ignore_errors=True)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return archive_path
+
+
+# ---------------------------------------------------------------------------
+# Fake Telegram
+# ---------------------------------------------------------------------------
+
+class FakeNetwork:
+    """Simulated link shared by the fake clients: per-stream bandwidth, per-call latency and periodic flood waits."""
+
+    def __init__(self, download_bandwidth, upload_bandwidth, latency, flood_every, flood_seconds):
+        self.download_bandwidth = download_bandwidth
+        self.upload_bandwidth = upload_bandwidth
+        self.latency = latency
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+
+    async def transfer(self, size, bandwidth):
+        await asyncio.sleep(self.latency + (size / bandwidth if bandwidth else 0))
+
+
+class FakeTelethon:
+    """Stands in for the Telethon client: serves the archive for download and records uploads and sends."""
+
+    def __init__(self, network, archive_path):
+        self.network = network
+        self.archive_path = archive_path
+        self.first_send = None
+        self.send_calls = 0
+        self.upload_calls = 0
+        self.files_sent = 0
+        self.bytes_uploaded = 0
+        self.flood_waits = 0
+        self.next_document_id = 1
+
+    async def get_messages(self, chat_id, ids):
+        document = types.SimpleNamespace(size=os.path.getsize(self.archive_path), path=self.archive_path)
+        return types.SimpleNamespace(document=document)
+
+    async def iter_download(self, document, offset=0, request_size=512 * 1024, limit=None, file_size=None):
+        with open(document.path, "rb") as archive:
+            archive.seek(offset)
+            for _ in range(limit):
+                chunk = archive.read(request_size)
+                if not chunk:
+                    return
+                await self.network.transfer(len(chunk), self.network.download_bandwidth)
+                yield chunk
+
+    async def upload_file(self, file_path, part_size_kb=512, **kwargs):
+        self.upload_calls += 1
+        size = 0
+        with open(file_path, "rb") as upload:
+            while part := upload.read(int(part_size_kb * 1024)):
+                size += len(part)
+                await self.network.transfer(len(part), self.network.upload_bandwidth)
+        self.bytes_uploaded += size
+        return types.SimpleNamespace(name=os.path.basename(file_path), size=size)
+
+    async def send_file(self, chat_id, file, **kwargs):
+        self.send_calls += 1
+        if self.network.flood_every and self.send_calls % self.network.flood_every == 0:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.network.flood_seconds)
+        await self.network.transfer(0, 0)
+        if self.first_send is None:
+            self.first_send = time.monotonic()
+        files = file if isinstance(file, list) else [file]
+        self.files_sent += len(files)
+        messages = [types.SimpleNamespace(media=self.fake_media()) for _ in files]
+        return messages if isinstance(file, list) else messages[0]
+
+    def fake_media(self):
+        """Media that telethon.utils.pack_bot_file_id turns into a file_id, so the caches can be exercised."""
+        self.next_document_id += 1
+        document = tl_types.Document(id=self.next_document_id, access_hash=self.next_document_id, file_reference=b"", date=None,
+                                     mime_type="application/octet-stream", size=0, dc_id=2, attributes=[])
+        return tl_types.MessageMediaDocument(document=document)
+
+
+class FakeBot:
+    """Stands in for the python-telegram-bot Bot. Answers password and filter questions like a user would."""
+
+    def __init__(self, file_filter):
+        self.file_filter = file_filter
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append(text)
+        if "password-protected" in text:
+            self.answer(BENCHMARK_PASSWORD)
+        elif text.startswith("Which files do you want?"):
+            self.answer(self.file_filter)
+
+    def answer(self, text):
+        answer_update = fake_update(text=text)
+        asyncio.get_running_loop().call_soon(asyncio.create_task, unzipbot.receive_answer(answer_update, None))
+
+
+def fake_update(document=None, text=None):
+    """A python-telegram-bot Update with just the fields the handlers read."""
+
+    async def reply_text(text, **kwargs):
+        return None
+
+    message = types.SimpleNamespace(
+        chat_id=BENCHMARK_USER_ID, message_id=1, from_user=types.SimpleNamespace(id=BENCHMARK_USER_ID),
+        document=document, caption=None, text=text, reply_text=reply_text,
+    )
+    return types.SimpleNamespace(message=message)
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+class ResourceSampler(threading.Thread):
+    """Polls the RSS of the bot and its worker processes, and the bytes in its temp directories, keeping the peaks."""
+
+    def __init__(self, temp_dirs, interval=0.05):
+        super().__init__(daemon=True)
+        self.temp_dirs = [temp_dir for temp_dir in temp_dirs if temp_dir]
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        process = psutil.Process()
+        while not self.stopped.is_set():
+            rss = 0
+            for proc in [process] + process.children(recursive=True):
+                try:
+                    rss += proc.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_disk = max(self.peak_disk, sum(directory_size(temp_dir) for temp_dir in self.temp_dirs))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+async def run_scenario(archive_path, network, file_filter):
+    """Push one archive through handle_file_loop and measure it."""
+    telethon = FakeTelethon(network, archive_path)
+    bot = FakeBot(file_filter)
+    unzipbot.telethon = telethon
+    unzipbot.unzipbot = bot
+    unzipbot.job_scheduler = unzipbot.JobScheduler()
+
+    size = os.path.getsize(archive_path)
+    document = types.SimpleNamespace(
+        file_name=os.path.basename(archive_path), file_size=size, file_unique_id=f"benchmark-{time.monotonic_ns()}",
+    )
+    sampler = ResourceSampler([unzipbot.TEMP_DIR, unzipbot.RAM_TEMP_DIR])
+    sampler.start()
+    started = time.monotonic()
+    try:
+        await unzipbot.handle_file_loop(fake_update(document=document), None)
+        # The handler only queues the job; the scheduler runs it in a task of its own
+        await asyncio.gather(*unzipbot.job_scheduler.tasks)
+    finally:
+        finished = time.monotonic()
+        sampler.stop()
+    return {
+        "archive_bytes": size,
+        "wall_s": round(finished - started, 3),
+        "time_to_first_file_s": round(telethon.first_send - started, 3) if telethon.first_send else None,
+        "peak_rss_mb": round(sampler.peak_rss / 1024 / 1024, 1),
+        "peak_temp_disk_mb": round(sampler.peak_disk / 1024 / 1024, 1),
+        "files_sent": telethon.files_sent,
+        "send_calls": telethon.send_calls,
+        "upload_calls": telethon.upload_calls,
+        "bytes_uploaded": telethon.bytes_uploaded,
+        "flood_waits": telethon.flood_waits,
+        "completed": "Extraction complete!" in bot.messages,
+    }
+
+
+def scenarios(formats, scenario_filter):
+    for archive_format in formats:
+        for shape in SHAPES:
+            for kind in ("photos", "documents"):
+                for encrypted in (False, True):
+                    name = f"{archive_format}/{shape}/{kind}/{'encrypted' if encrypted else 'plain'}"
+                    if scenario_filter and not all(part in name for part in scenario_filter.split(",")):
+                        continue
+                    yield name, archive_format, shape, kind, encrypted
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    """Print how each scenario changed against an earlier run."""
+    previous = {result["scenario"]: result for result in baseline["results"]}
+    columns = ("wall_s", "time_to_first_file_s", "peak_rss_mb", "peak_temp_disk_mb", "send_calls")
+    print(f"{'scenario':<42}" + "".join(f"{column:>24}" for column in columns), file=sys.stderr)
+    for result in current["results"]:
+        old = previous.get(result["scenario"])
+        if not old or "skipped" in result or "skipped" in old:
+            continue
+        cells = []
+        for column in columns:
+            before, after = old.get(column), result.get(column)
+            if before is None or after is None:
+                cells.append(f"{'-':>24}")
+            else:
+                change = f"{(after - before) / before * 100:+.0f}%" if before else ""
+                cells.append(f"{f'{before:g} -> {after:g} {change}':>24}")
+        print(f"{result['scenario']:<42}" + "".join(cells), file=sys.stderr)
+
+
+async def run_all(args, corpus_dir, network):
+    results = []
+    for name, archive_format, shape, kind, encrypted in scenarios(args.formats.split(","), args.scenario):
+        try:
+            archive_path = build_corpus(corpus_dir, archive_format, shape, kind, encrypted, args.scale)
+        except RuntimeError as e:
+            results.append({"scenario": name, "skipped": str(e)})
+            print(f"{name}: skipped ({e})", file=sys.stderr)
+            continue
+        for run in range(args.repeat):
+            result = await run_scenario(archive_path, network, args.filter)
+            result.update(scenario=name, run=run + 1)
+            results.append(result)
+            print(f"{name} run {run + 1}: {result['wall_s']}s wall, {result['time_to_first_file_s']}s to first file, "
+                  f"{result['peak_rss_mb']} MB peak RSS, {result['peak_temp_disk_mb']} MB peak disk", file=sys.stderr)
+    return results
+
+
+def main():
+    global unzipbot
+
+    parser = argparse.ArgumentParser(description="Benchmark the unzip pipeline against a simulated Telegram.")
+    parser.add_argument("--formats", default="zip,rar,7z,tar.gz", help="comma-separated archive formats")
+    parser.add_argument("--scenario", help="only run scenarios whose name contains all of these comma-separated parts")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every generated file size by this")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario")
+    parser.add_argument("--download-mbps", type=float, default=80, help="simulated download bandwidth per stream (Mbit/s, 0 = unlimited)")
+    parser.add_argument("--upload-mbps", type=float, default=40, help="simulated upload bandwidth per upload (Mbit/s, 0 = unlimited)")
+    parser.add_argument("--latency-ms", type=float, default=50, help="simulated latency per API call")
+    parser.add_argument("--send-rate", type=float, help="messages per second the bot allows itself (default: SEND_RATE from unzipbot)")
+    parser.add_argument("--flood-every", type=int, default=50, help="answer every Nth send with a flood wait (0 = never)")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="length of each simulated flood wait")
+    parser.add_argument("--filter", default="all", help='answer to the bot\'s filter question, e.g. "media" or "<1MB"')
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "unzipbot-benchmark"), help="where corpora and temp files go")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    corpus_dir = os.path.join(args.workdir, "corpus")
+    run_dir = os.path.join(args.workdir, "run")
+    os.makedirs(corpus_dir, exist_ok=True)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    # unzipbot creates TEMP_DIR, its log and its cache database relative to the working directory
+    os.chdir(run_dir)
+    import unzipbot as bot_module
+    unzipbot = bot_module
+
+    network = FakeNetwork(
+        download_bandwidth=args.download_mbps * 1024 * 1024 / 8,
+        upload_bandwidth=args.upload_mbps * 1024 * 1024 / 8,
+        latency=args.latency_ms / 1000,
+        flood_every=args.flood_every,
+        flood_seconds=args.flood_seconds,
+    )
+    if args.send_rate:
+        unzipbot.SEND_RATE = args.send_rate
+    unzipbot.start_services()
+    try:
+        results = asyncio.run(run_all(args, corpus_dir, network))
+    finally:
+        unzipbot.stop_services()
+
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "workdir")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(json.load(baseline), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,4 +13,106 @@ BOT_TOKEN = ""  # unzipstuff_bot
 # This info gives you access to a more advanced API that will deliver a list of participants in your chat, leading to better kicking accuracy. 
 # To get these, go to my.telegram.org and create an app.
 API_ID = XXXXXXX
-API_HASH = ""
\ No newline at end of file
+API_HASH = ""
+
+""" EXTRACTION """
+# Number of worker processes used to decompress archives. Leave as None to use one per CPU core.
+EXTRACTION_WORKERS = None
+
+
+""" TEMP FILES """
+# Every archive is downloaded and extracted in a directory of its own under temp_files. Archives up to
+# RAM_WORKSPACE_MAX_SIZE bytes can use a RAM disk instead, e.g. RAM_TEMP_DIR = "/dev/shm/unzipbot". None turns it off.
+RAM_TEMP_DIR = None
+RAM_WORKSPACE_MAX_SIZE = 64 * 1024 * 1024
+
+# At startup the bot deletes leftovers of earlier runs (after a crash, say) that are older than WORKSPACE_TTL seconds,
+# then the oldest remaining ones until they take up no more than TEMP_DIR_QUOTA bytes. None means no quota. Only the
+# bot's own job-* workspaces and parked partial downloads are deleted; other files in these directories are left alone,
+# and so are the workspaces of unfinished jobs that are about to be resumed.
+WORKSPACE_TTL = 24 * 60 * 60
+TEMP_DIR_QUOTA = None
+
+
+""" JOBS """
+# Number of archives processed at the same time. Further archives wait in a queue that takes turns between users.
+MAX_ACTIVE_JOBS = 4
+
+# How many of the active archives may be downloading, extracting or uploading at the same time.
+MAX_DOWNLOADS = 2
+MAX_EXTRACTIONS = 4
+MAX_UPLOADS = 2
+
+# New archives wait while free disk space (after the archive itself) or available memory drops below these, in bytes.
+MIN_FREE_DISK = 1024 * 1024 * 1024
+MIN_FREE_MEMORY = 256 * 1024 * 1024
+
+
+""" DOWNLOADS """
+# Number of parts of an archive downloaded at the same time, and the size of each part in bytes.
+# The part size must be a multiple of 1 MB. Interrupted downloads resume from the last finished part.
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_PART_SIZE = 4 * 1024 * 1024
+
+
+""" UPLOADS """
+# Number of extracted files uploaded at the same time for each archive.
+UPLOAD_CONCURRENCY = 4
+
+# Bytes of extracted files an archive may have waiting on disk to be uploaded and sent. A single file larger than this
+# is still sent, but on its own.
+UPLOAD_BUFFER_SIZE = 1024 * 1024 * 1024
+
+# Messages per second the bot may send across all chats, and how many may go out in a quick burst.
+# Telegram answers with a flood wait when these are too high; the bot then pauses all sending.
+SEND_RATE = 1
+SEND_BURST = 20
+
+# Send runs of photos and videos as albums of up to 10 instead of one message each.
+ALBUM_MODE = True
+
+# Small files other than photos, videos and audio (under BUNDLE_FILE_SIZE bytes) are packed into uncompressed zips of up
+# to BUNDLE_MAX_SIZE bytes once an archive has at least BUNDLE_MIN_FILES of them, so a folder of source code arrives as
+# one document instead of thousands of messages. Set BUNDLE_FILE_SIZE to 0 to send every file on its own.
+BUNDLE_FILE_SIZE = 1024 * 1024
+BUNDLE_MIN_FILES = 10
+BUNDLE_MAX_SIZE = 2000 * 1024 * 1024
+
+# Number of extracted files whose Telegram file_id is remembered, so identical files in later archives are
+# re-sent without uploading them again. Set to 0 to turn the cache off.
+FILE_ID_CACHE_SIZE = 100000
+
+# Number of archives whose results are remembered. When the same archive document is sent again, the bot re-sends
+# the files from last time without downloading or extracting anything. Set to 0 to turn the cache off.
+ARCHIVE_CACHE_SIZE = 1000
+ARCHIVE_CACHE_TTL = 30 * 24 * 60 * 60  # Seconds a remembered archive stays valid
+
+# Whether password-protected archives are remembered too. A repeat of such an archive is then answered without
+# asking for the password again.
+CACHE_PASSWORD_PROTECTED_ARCHIVES = False
+
+
+""" JOURNAL """
+# Unfinished archives are recorded in unzipbot_journal.sqlite3 and picked up again when the bot restarts, without
+# downloading them again or re-sending files that already went out. Passwords are not recorded, so a protected
+# archive asks for its password again. An archive that was interrupted more than JOURNAL_MAX_RESUMES times is dropped.
+JOB_JOURNAL = True
+JOURNAL_MAX_RESUMES = 3
+
+
+""" FILTERS """
+# Before extracting, the bot lists the archive and shows a summary. For archives with at least FILTER_PROMPT_MIN_FILES
+# files it then asks which files to send (all, media only, a path glob like "photos/*" or a size limit like "<20MB").
+# Without an answer within FILTER_TIMEOUT seconds it sends everything. Set FILTER_TIMEOUT to 0 to never ask.
+FILTER_TIMEOUT = 60
+FILTER_PROMPT_MIN_FILES = 20
+
+
+""" METRICS """
+# The /stats command shows timings, throughput and retry counts to ALLOWED_USERS. The same metrics can be exported
+# in the Prometheus text format to a file (rewritten every METRICS_INTERVAL seconds) and/or served over HTTP on
+# METRICS_HOST:METRICS_PORT. Leave as None to turn an export off.
+METRICS_FILE = None  # e.g. "unzipbot.prom" for the node_exporter textfile collector
+METRICS_INTERVAL = 15
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None  # e.g. 9464
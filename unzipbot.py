@@ -1,16 +1,39 @@
 import os
+import re
+import queue
+import shutil
+import subprocess
 import zipfile
 import rarfile
 import gzip
+import zlib
+import lzma
 import tarfile
 import py7zr
+import time
+import fnmatch
+import hashlib
+import tempfile
+import sqlite3
+import json
+import itertools
+import contextlib
+import collections
+import psutil
 import logging
 import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from logging.handlers import TimedRotatingFileHandler
+import config
 from config import BOT_TOKEN, API_ID, API_HASH, ALLOWED_USERS
-from telegram import Update, error, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, ConversationHandler
+from telegram import Update, error, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.constants import MessageLimit
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
 from telethon.sync import TelegramClient
+from telethon import utils as telethon_utils
+from telethon.errors import FloodWaitError, ServerError
 
 # Path to store temporary files
 TEMP_DIR = "temp_files"
@@ -18,38 +41,149 @@ TEMP_DIR = "temp_files"
 # Ensure TEMP_DIR exists
 os.makedirs(TEMP_DIR, exist_ok=True)
 
-# Configure logging
-when = 'midnight'  # Rotate logs at midnight (other options include 'H', 'D', 'W0' - 'W6', 'MIDNIGHT', or a custom time)
-interval = 1  # Rotate daily
-backup_count = 7  # Retain logs for 7 days
-log_handler = TimedRotatingFileHandler('app.log', when=when, interval=interval, backupCount=backup_count)
-log_handler.suffix = "%Y-%m-%d"  # Suffix for log files (e.g., 'my_log.log.2023-10-22')
+# Every job works in its own directory under TEMP_DIR. Unfinished downloads are parked in PARTIAL_DIR so that
+# sending the same document again resumes them.
+PARTIAL_DIR = os.path.join(TEMP_DIR, "partial")
+WORKSPACE_PREFIX = "job-"
+# Optional RAM disk (e.g. a directory on /dev/shm) for the workspaces of archives up to RAM_WORKSPACE_MAX_SIZE
+RAM_TEMP_DIR = getattr(config, "RAM_TEMP_DIR", None)
+RAM_WORKSPACE_MAX_SIZE = getattr(config, "RAM_WORKSPACE_MAX_SIZE", 64 * 1024 * 1024)
+# At startup, leftovers of earlier runs older than WORKSPACE_TTL are deleted, then the oldest of the rest
+# until they fit in TEMP_DIR_QUOTA bytes (None for no quota)
+WORKSPACE_TTL = getattr(config, "WORKSPACE_TTL", 24 * 60 * 60)
+TEMP_DIR_QUOTA = getattr(config, "TEMP_DIR_QUOTA", None)
 
-logging.basicConfig(
-    level=logging.WARNING,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        log_handler,
-    ]
-)
+# Number of worker processes used for decompression (defaults to one per core)
+EXTRACTION_WORKERS = getattr(config, "EXTRACTION_WORKERS", None) or os.cpu_count()
 
-# Create a separate handler for console output with a higher level (WARNING)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.WARNING)  # Set the level to WARNING or higher
-console_formatter = logging.Formatter("UNZIPBOT: %(message)s")
-console_handler.setFormatter(console_formatter)
+# Parallel download streams per archive, and the size of each downloaded part (a multiple of 1 MB)
+DOWNLOAD_CONNECTIONS = getattr(config, "DOWNLOAD_CONNECTIONS", 4)
+DOWNLOAD_PART_SIZE = getattr(config, "DOWNLOAD_PART_SIZE", 4 * 1024 * 1024)
+DOWNLOAD_REQUEST_SIZE = 512 * 1024  # Telegram's largest file chunk per request
+if DOWNLOAD_PART_SIZE % (1024 * 1024):
+    raise ValueError("DOWNLOAD_PART_SIZE must be a multiple of 1 MB")
 
-# Attach the console handler to the root logger
-logging.getLogger().addHandler(console_handler)
+# Archives processed at once, and how many of them may be in each stage at the same time
+MAX_ACTIVE_JOBS = getattr(config, "MAX_ACTIVE_JOBS", 4)
+MAX_DOWNLOADS = getattr(config, "MAX_DOWNLOADS", 2)
+MAX_EXTRACTIONS = getattr(config, "MAX_EXTRACTIONS", EXTRACTION_WORKERS)
+MAX_UPLOADS = getattr(config, "MAX_UPLOADS", 2)
+
+# New jobs wait while free space in TEMP_DIR (after the archive) or available memory is below these
+MIN_FREE_DISK = getattr(config, "MIN_FREE_DISK", 1024 * 1024 * 1024)  # 1 GB
+MIN_FREE_MEMORY = getattr(config, "MIN_FREE_MEMORY", 256 * 1024 * 1024)  # 256 MB
+RESOURCE_CHECK_INTERVAL = 5  # Seconds between checks while jobs are held back
+
+# Uploads kept in flight at once per job, and the size of each uploaded part (512 KB is Telegram's maximum)
+UPLOAD_CONCURRENCY = getattr(config, "UPLOAD_CONCURRENCY", 4)
+UPLOAD_PART_SIZE_KB = 512
+# Bytes of extracted files a job may have waiting for upload or sending. A single larger file is still let through,
+# but then on its own.
+UPLOAD_BUFFER_SIZE = getattr(config, "UPLOAD_BUFFER_SIZE", 1024 * 1024 * 1024)
+
+# Send consecutive photos and videos as albums of up to ALBUM_SIZE (Telegram's maximum)
+ALBUM_MODE = getattr(config, "ALBUM_MODE", True)
+ALBUM_SIZE = 10
+PHOTO_EXTENSIONS = ('jpg', 'jpeg', 'png')
+VIDEO_EXTENSIONS = ('mp4', 'mov')
+# Other media Telegram plays or previews in the chat. Not sent in albums, but never bundled and kept by "media"
+OTHER_PHOTO_EXTENSIONS = ('gif', 'webp', 'bmp', 'heic', 'heif', 'tif', 'tiff')
+OTHER_VIDEO_EXTENSIONS = ('mkv', 'webm', 'avi', 'm4v', '3gp', 'mpg', 'mpeg', 'wmv')
+AUDIO_EXTENSIONS = ('mp3', 'm4a', 'aac', 'ogg', 'oga', 'opus', 'flac', 'wav')
+PHOTO_SIZE_LIMIT = 10 * 1024 * 1024  # Larger photos are sent as documents
+
+# Small files other than photos, videos and audio are packed into store-only zips of up to BUNDLE_MAX_SIZE (Telegram's
+# document limit) once an archive has BUNDLE_MIN_FILES of them, instead of being sent one message each
+BUNDLE_FILE_SIZE = getattr(config, "BUNDLE_FILE_SIZE", 1024 * 1024)  # Files below this are bundled; 0 turns it off
+BUNDLE_MIN_FILES = getattr(config, "BUNDLE_MIN_FILES", 10)
+BUNDLE_MAX_SIZE = getattr(config, "BUNDLE_MAX_SIZE", 2000 * 1024 * 1024)
+ZIP_ENTRY_OVERHEAD = 128  # Bytes of local header, central directory record and extras per member, besides the name
+
+# Messages per second allowed across all jobs, and how many may be sent in a burst
+SEND_RATE = getattr(config, "SEND_RATE", 1)
+SEND_BURST = getattr(config, "SEND_BURST", 20)
+SEND_RETRIES = 5
+RETRY_BASE_DELAY = 2  # Seconds, doubled after every failed attempt
+
+# Cache of Telegram file_ids for extracted files, keyed by content hash, so repeated files are not re-uploaded
+CACHE_DB = os.path.join(os.path.dirname(os.path.abspath(TEMP_DIR)), "unzipbot_cache.sqlite3")
+FILE_ID_CACHE_SIZE = getattr(config, "FILE_ID_CACHE_SIZE", 100000)  # Entries kept; 0 disables the cache
+
+# Cache of the messages sent for whole archives, keyed by the document's file_unique_id
+ARCHIVE_CACHE_SIZE = getattr(config, "ARCHIVE_CACHE_SIZE", 1000)  # Archives kept; 0 disables the cache
+ARCHIVE_CACHE_TTL = getattr(config, "ARCHIVE_CACHE_TTL", 30 * 24 * 60 * 60)  # 30 days
+# Off by default: a cache hit would hand out the contents of a protected archive without asking for the password
+CACHE_PASSWORD_PROTECTED_ARCHIVES = getattr(config, "CACHE_PASSWORD_PROTECTED_ARCHIVES", False)
+
+# Journal of unfinished jobs, so they resume after a restart without repeating finished downloads or sent files.
+# A job that was interrupted more than JOURNAL_MAX_RESUMES times is given up, in case it is what crashes the bot.
+JOB_JOURNAL = getattr(config, "JOB_JOURNAL", True)
+JOURNAL_DB = os.path.join(os.path.dirname(os.path.abspath(TEMP_DIR)), "unzipbot_journal.sqlite3")
+JOURNAL_MAX_RESUMES = getattr(config, "JOURNAL_MAX_RESUMES", 3)
+
+# Optional Prometheus exports of the metrics shown by /stats: a text file rewritten every METRICS_INTERVAL
+# seconds, and an HTTP endpoint on METRICS_HOST:METRICS_PORT. Both are off when left as None.
+METRICS_FILE = getattr(config, "METRICS_FILE", None)
+METRICS_INTERVAL = getattr(config, "METRICS_INTERVAL", 15)
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", None)
+
+# After listing an archive, ask for a filter (e.g. media only) when it has at least FILTER_PROMPT_MIN_FILES files.
+# Without an answer within FILTER_TIMEOUT seconds everything is sent; 0 never asks.
+FILTER_TIMEOUT = getattr(config, "FILTER_TIMEOUT", 60)
+FILTER_PROMPT_MIN_FILES = getattr(config, "FILTER_PROMPT_MIN_FILES", 20)
+
+def configure_logging():
+    """Log to app.log and the console. Only the main process may do this: the extraction workers import this
+    module too, and a second handler rotating app.log would delete the log the main process just rotated."""
+    when = 'midnight'  # Rotate logs at midnight (other options include 'H', 'D', 'W0' - 'W6', 'MIDNIGHT', or a custom time)
+    interval = 1  # Rotate daily
+    backup_count = 7  # Retain logs for 7 days
+    log_handler = TimedRotatingFileHandler('app.log', when=when, interval=interval, backupCount=backup_count)
+    log_handler.suffix = "%Y-%m-%d"  # Suffix for log files (e.g., 'my_log.log.2023-10-22')
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            log_handler,
+        ]
+    )
+
+    # Create a separate handler for console output with a higher level (WARNING)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.WARNING)  # Set the level to WARNING or higher
+    console_formatter = logging.Formatter("UNZIPBOT: %(message)s")
+    console_handler.setFormatter(console_formatter)
+
+    # Attach the console handler to the root logger
+    logging.getLogger().addHandler(console_handler)
+
+
+def configure_worker_logging():
+    """Extraction workers log to the console only, so they never touch app.log."""
+    logging.basicConfig(level=logging.WARNING, format="UNZIPBOT: %(message)s")
 
 
 # Global variables
 unzipbot = None
 app = None
 telethon = None
-last_reported_progress = 0
+extraction_pool = None
+extraction_manager = None
+send_limiter = None
+background_tasks = set()  # Tasks outside any job, cancelled at shutdown
+file_id_cache = None
+archive_cache = None
+job_journal = None
+job_scheduler = None
+pending_questions = {}  # user_id -> jobs waiting for the user to answer, oldest first
 MIN_PROGRESS_UPDATE_SIZE = 3 * 1024 * 1024  # 3 MB
-WAITING_FOR_PASSWORD = 1
+EXTRACT_QUEUE_SIZE = 4  # Extracted files allowed to wait on disk for upload
+ENTRY_POLL_INTERVAL = 1  # Seconds between checks that the extraction worker is still alive
+ZIP_ENCRYPTED_FLAG = 0x1  # General purpose flag bit of encrypted zip members
+COPY_BUFFER_SIZE = 1024 * 1024  # 1 MB
+PASSWORD_TIMEOUT = 10 * 60  # Seconds to wait for the password of a protected archive
 
 async def start(update: Update, context: CallbackContext) -> None:
     requester_id = update.message.from_user.id
@@ -60,318 +194,2032 @@ async def start(update: Update, context: CallbackContext) -> None:
     except Exception as e:
         logging.error(f"An error occurred in start: {e}")
 
-async def handle_file(update: Update, context: CallbackContext) -> None:
-    """Handle file uploads."""
-    # Get the file
 
+class Metrics:
+    """Counters and per-stage timings, shown by /stats and exported as Prometheus text.
+
+    Every stage is timed per archive format with a latency histogram, together
+    with the bytes that went in and out of it.
+    """
+
+    BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)  # Seconds
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = collections.Counter()  # (name, labels) -> value
+        self.stages = {}  # (stage, archive_format) -> totals and histogram buckets
+
+    def count(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, stage, archive_format, seconds, bytes_in=0, bytes_out=0):
+        stats = self.stages.setdefault((stage, archive_format), {
+            "count": 0, "seconds": 0.0, "max": 0.0, "bytes_in": 0, "bytes_out": 0, "buckets": [0] * len(self.BUCKETS),
+        })
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += bytes_out
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                stats["buckets"][i] += 1
+
+    def timer(self, stage, archive_format):
+        return StageTimer(self, stage, archive_format)
+
+    def summary(self):
+        """Human-readable overview for /stats."""
+        lines = [f"Up for {format_duration(time.time() - self.started)}"]
+        if job_scheduler:
+            lines.append(f"Jobs: {job_scheduler.active} active, {len(job_scheduler.waiting_jobs())} queued")
+        for (stage, archive_format), stats in sorted(self.stages.items()):
+            throughput = max(stats["bytes_in"], stats["bytes_out"]) / stats["seconds"] / 1024 / 1024 if stats["seconds"] else 0
+            lines.append(
+                f"{stage} [{archive_format}]: {stats['count']}x, avg {stats['seconds'] / stats['count']:.2f}s, "
+                f"max {stats['max']:.2f}s, {stats['bytes_in'] / 1024 / 1024:.1f} MB in, "
+                f"{stats['bytes_out'] / 1024 / 1024:.1f} MB out, {throughput:.2f} MB/s"
+            )
+        for (name, labels), value in sorted(self.counters.items()):
+            label_text = ", ".join(f"{key}={label}" for key, label in labels)
+            lines.append(f"{name}{f' ({label_text})' if label_text else ''}: {value:g}")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format."""
+        lines = [
+            "# TYPE unzipbot_stage_seconds histogram",
+        ]
+        for (stage, archive_format), stats in sorted(self.stages.items()):
+            labels = f'stage="{stage}",format="{archive_format}"'
+            for bound, count in zip(self.BUCKETS, stats["buckets"]):
+                lines.append(f'unzipbot_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'unzipbot_stage_seconds_bucket{{{labels},le="+Inf"}} {stats["count"]}')
+            lines.append(f'unzipbot_stage_seconds_sum{{{labels}}} {stats["seconds"]}')
+            lines.append(f'unzipbot_stage_seconds_count{{{labels}}} {stats["count"]}')
+        for direction in ("in", "out"):
+            lines.append(f"# TYPE unzipbot_stage_bytes_{direction}_total counter")
+            for (stage, archive_format), stats in sorted(self.stages.items()):
+                lines.append(f'unzipbot_stage_bytes_{direction}_total{{stage="{stage}",format="{archive_format}"}} {stats["bytes_" + direction]}')
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE unzipbot_{name}_total counter")
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                    lines.append(f"unzipbot_{name}_total{{{label_text}}} {value}")
+        if job_scheduler:
+            lines.append("# TYPE unzipbot_active_jobs gauge")
+            lines.append(f"unzipbot_active_jobs {job_scheduler.active}")
+            lines.append("# TYPE unzipbot_queued_jobs gauge")
+            lines.append(f"unzipbot_queued_jobs {len(job_scheduler.waiting_jobs())}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class StageTimer:
+    """Context manager that records how long a stage took, plus the bytes set on it meanwhile."""
+
+    def __init__(self, metrics, stage, archive_format):
+        self.metrics = metrics
+        self.stage = stage
+        self.archive_format = archive_format
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.metrics.count("stage_failures", stage=self.stage, format=self.archive_format)
+            return False
+        self.metrics.observe(self.stage, self.archive_format, time.monotonic() - self.started, self.bytes_in, self.bytes_out)
+        return False
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes}m {seconds}s"
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def archive_format(file_name):
+    """Short format label for metrics, e.g. "zip" or "tar.gz"."""
+    if file_name.endswith(('.tar.gz', '.tgz')):
+        return "tar.gz"
+    return os.path.splitext(file_name)[1].lstrip('.').lower()
+
+
+async def stats(update: Update, context: CallbackContext) -> None:
+    """Show the bot's metrics."""
     requester_id = update.message.from_user.id
     if requester_id not in ALLOWED_USERS:
         return
-    
-    global last_reported_progress
-    file = update.message.document
-    chat_id = update.message.chat_id
-    message_id = update.message.message_id
-    if not file:
+    try:
+        for text in split_message(metrics.summary()):
+            await update.message.reply_text(text)
+    except Exception as e:
+        logging.error(f"An error occurred in stats: {e}")
+
+
+def split_message(text, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """Break text into chunks Telegram accepts, splitting between lines where possible."""
+    chunks = []
+    chunk = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if chunk:
+                chunks.append(chunk)
+                chunk = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if chunk and len(chunk) + 1 + len(line) > limit:
+            chunks.append(chunk)
+            chunk = line
+        else:
+            chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+async def export_metrics(application: Application) -> None:
+    """Start the optional Prometheus exports: a text file rewritten every METRICS_INTERVAL seconds and a local HTTP endpoint."""
+    if METRICS_PORT:
+        async def serve_metrics(reader, writer):
+            try:
+                await reader.readline()  # The request line; every path serves the metrics
+                body = metrics.prometheus().encode()
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n")
+                writer.write(f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+            except Exception as e:
+                logging.error(f"An error occurred while serving metrics: {e}")
+            finally:
+                writer.close()
+
+        await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+
+    if METRICS_FILE:
+        async def write_metrics_file():
+            while True:
+                try:
+                    with open(METRICS_FILE + ".tmp", 'w') as metrics_file:
+                        metrics_file.write(metrics.prometheus())
+                    os.replace(METRICS_FILE + ".tmp", METRICS_FILE)
+                except Exception as e:
+                    logging.error(f"An error occurred while writing {METRICS_FILE}: {e}")
+                await asyncio.sleep(METRICS_INTERVAL)
+
+        task = asyncio.create_task(write_metrics_file())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+class Job:
+    """One archive on its way from the user's message to the extracted files."""
+
+    ids = itertools.count(1)
+
+    def __init__(self, chat_id, user_id, message_id, file_name, file_size, file_unique_id, file_filter=None):
+        self.id = next(Job.ids)
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_unique_id = file_unique_id
+        self.archive_format = archive_format(self.file_name)
+        self.started = time.monotonic()
+        self.workspace = None  # Created by create_workspace() once the job is admitted
+        self.original_file_path = None
+        self.extracted_dir = None
+        self.password = None
+        self.answer = None  # Future that receive_answer resolves
+        self.file_filter = file_filter  # Set from the caption or the filter question
+        self.filter_chosen = file_filter is not None
+        self.last_reported_progress = 0
+        self.admitted = asyncio.Event()
+        # Progress kept in the job journal
+        self.journal_id = None
+        self.resumes = 0
+        self.downloaded = False
+        self.sent_members = set()  # Archive members delivered before a restart
+        self.held_back = False  # Waiting for disk space or memory
+
+    @classmethod
+    def from_message(cls, message):
+        document = message.document
+        return cls(message.chat_id, message.from_user.id, message.message_id, document.file_name, document.file_size,
+                   document.file_unique_id, FileFilter.from_caption(message.caption or ""))
+
+    async def reply(self, text, **kwargs):
+        return await unzipbot.send_message(self.chat_id, text, **kwargs)
+
+    def create_workspace(self):
+        """Give the job a directory of its own, so archives with the same name cannot collide.
+
+        Small archives go to RAM_TEMP_DIR when it has room for the archive and its
+        extracted files in flight. A parked partial download of the same document
+        is moved in, so its download resumes.
+        """
+        if self.workspace and os.path.isdir(self.workspace):
+            return  # Resumed from the journal with its workspace intact
+        self.downloaded = False
+        partial_path = os.path.join(PARTIAL_DIR, self.file_unique_id)
+        root = TEMP_DIR
+        if (RAM_TEMP_DIR and self.file_size <= RAM_WORKSPACE_MAX_SIZE and not os.path.exists(partial_path)
+                and shutil.disk_usage(RAM_TEMP_DIR).free >= 4 * self.file_size):
+            root = RAM_TEMP_DIR
+        self.use_workspace(tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{self.id}-", dir=root))
         try:
-            await update.message.reply_text("Please send a valid compressed file (.zip, .rar, .7z, .gz).")
-        except Exception as e:
-            logging.error(f"An error occurred while replying: {e}")
-        return
+            # Renaming is atomic, so only one job can claim a partial download
+            os.replace(partial_path, self.original_file_path)
+            os.replace(partial_path + ".parts", self.original_file_path + ".parts")
+        except OSError:
+            pass
+
+    def use_workspace(self, workspace):
+        self.workspace = workspace
+        self.original_file_path = os.path.join(workspace, os.path.basename(self.file_name))
+        self.extracted_dir = os.path.join(workspace, "extracted")
 
-    file_name = file.file_name
-    file_size = file.file_size
-    if not (file_name.endswith(('.zip', '.rar', '.7z', '.gz'))):
+    def park_partial_download(self):
+        """Keep a failed download's finished parts for the next time this document is sent."""
         try:
-            await update.message.reply_text("Only .zip, .rar, .7z, or .gz files are supported.")
+            os.makedirs(PARTIAL_DIR, exist_ok=True)
+            partial_path = os.path.join(PARTIAL_DIR, self.file_unique_id)
+            os.replace(self.original_file_path + ".parts", partial_path + ".parts")
+            os.replace(self.original_file_path, partial_path)
+        except OSError:
+            pass  # Nothing downloaded yet, or the workspace is on the RAM disk and the parts are not worth copying
+
+
+class JobScheduler:
+    """Queues jobs per user and admits them round-robin across users.
+
+    At most MAX_ACTIVE_JOBS run at once, and a job is not admitted while free
+    disk space (after its archive) or memory is below MIN_FREE_DISK or
+    MIN_FREE_MEMORY; the next user's job that fits goes first. Admitted jobs
+    still take a slot per stage, so downloads, extractions and uploads are
+    capped separately.
+
+    The scheduler owns the tasks that run the jobs, rather than the handlers that
+    receive them, so that shutdown() can cancel them. A cancelled job keeps its
+    journal entry and workspace and is resumed after the restart.
+    """
+
+    def __init__(self):
+        self.queues = {}  # user_id -> deque of waiting jobs; the dict order is the round-robin order
+        self.active = 0
+        self.admission_retry_pending = False
+        self.stopping = False
+        self.tasks = set()
+        self.notifications = set()
+        self.download_slots = asyncio.Semaphore(MAX_DOWNLOADS)
+        self.extraction_slots = asyncio.Semaphore(MAX_EXTRACTIONS)
+        self.upload_slots = asyncio.Semaphore(MAX_UPLOADS)
+
+    def start(self, job):
+        """Run the job in a task of its own and return the task."""
+        task = asyncio.create_task(self.run(job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def shutdown(self):
+        """Cancel the running and waiting jobs and wait until they have let go of their resources."""
+        self.stopping = True
+        tasks = self.tasks | self.notifications
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self, job):
+        """Wait for the job's turn, then process it."""
+        if not self.can_ever_fit(job):
+            logging.warning(f"Rejecting job {job.id}: {job.file_name} ({job.file_size} bytes) can never fit on the disk")
+            if job_journal:
+                job_journal.finish(job)
+            try:
+                await job.reply(f"{job.file_name} is too big for this server's disk and cannot be processed.")
+            except Exception as e:
+                logging.error(f"An error occurred while replying: {e}")
+            return
+        self.queues.setdefault(job.user_id, collections.deque()).append(job)
+        self.admit_jobs()
+        try:
+            if not job.admitted.is_set():
+                position = self.waiting_jobs().index(job) + 1
+                try:
+                    await job.reply(f"{job.file_name} is number {position} in the queue.")
+                except Exception as e:
+                    logging.error(f"An error occurred while replying: {e}")
+                await job.admitted.wait()
+        except asyncio.CancelledError:
+            if not self.withdraw(job):
+                self.active -= 1  # Admitted just as it was cancelled
+            raise
+        try:
+            with metrics.timer("job", job.archive_format) as timer:
+                timer.bytes_in = job.file_size
+                await handle_file(job)
         except Exception as e:
-            logging.error(f"An error occurred while replying: {e}")
-        return
-    
-    try:    
-        async def progress_callback(current, total):
-            if file_size < MIN_PROGRESS_UPDATE_SIZE:
+            logging.error(f"An error occurred in job {job.id} ({job.file_name}): {e}")
+        finally:
+            self.active -= 1
+            self.admit_jobs()
+
+    def withdraw(self, job):
+        """Take a job out of the queue. Returns False if it was not waiting there."""
+        jobs = self.queues.get(job.user_id)
+        if not jobs or job not in jobs:
+            return False
+        jobs.remove(job)
+        if not jobs:
+            del self.queues[job.user_id]
+        return True
+
+    def waiting_jobs(self):
+        """Queued jobs in the order they will be admitted."""
+        rounds = itertools.zip_longest(*self.queues.values())
+        return [job for round_jobs in rounds for job in round_jobs if job is not None]
+
+    def admit_jobs(self):
+        while self.queues and self.active < MAX_ACTIVE_JOBS and not self.stopping:
+            # The first user in the rotation whose next job fits goes next, so a job waiting
+            # for resources does not hold up everyone else. Skipped users keep their place.
+            for user_id, jobs in self.queues.items():
+                if self.has_resources(jobs[0]):
+                    break
+            else:
+                self.retry_admission_later()
                 return
-            global last_reported_progress
-            progress = (current / total) * 100
-            rounded_progress = int(progress // 10 * 10)  # Round down to the nearest 10%
-
-            if rounded_progress > last_reported_progress:
-                last_reported_progress = rounded_progress
-                await update.message.reply_text(f"Download progress: {rounded_progress}%")
-
-        original_file_path = os.path.join(TEMP_DIR, file_name)
-        await update.message.reply_text("Archive file received. Processing...")
-        message = await telethon.get_messages(chat_id, ids=message_id)
-        
+            job = jobs.popleft()
+            # Move the user to the back of the rotation
+            del self.queues[user_id]
+            if jobs:
+                self.queues[user_id] = jobs
+            self.active += 1
+            job.admitted.set()
+
+    def has_resources(self, job):
+        free_disk = psutil.disk_usage(TEMP_DIR).free
+        available_memory = psutil.virtual_memory().available
+        if free_disk - job.file_size < MIN_FREE_DISK or available_memory < MIN_FREE_MEMORY:
+            if not job.held_back:
+                # Only the first time, as admission is retried every RESOURCE_CHECK_INTERVAL
+                job.held_back = True
+                logging.warning(f"Holding back job {job.id}: {free_disk} bytes of disk and {available_memory} bytes of memory free")
+                self.notify(job, f"{job.file_name} is waiting for disk space or memory to free up on the server.")
+            return False
+        return True
+
+    @staticmethod
+    def can_ever_fit(job):
+        """False if the archive is too big for TEMP_DIR's disk even with nothing else on it."""
+        return psutil.disk_usage(TEMP_DIR).total - job.file_size >= MIN_FREE_DISK
+
+    def notify(self, job, text):
+        """Send the user a message from synchronous scheduler code."""
+        task = asyncio.get_running_loop().create_task(job.reply(text))
+        self.notifications.add(task)
+        task.add_done_callback(self.notifications.discard)
+
+    def retry_admission_later(self):
+        if self.admission_retry_pending:
+            return
+        self.admission_retry_pending = True
+
+        def retry():
+            self.admission_retry_pending = False
+            self.admit_jobs()
+
+        asyncio.get_running_loop().call_later(RESOURCE_CHECK_INTERVAL, retry)
+
+    @contextlib.asynccontextmanager
+    async def suspended(self, job):
+        """Free the job's active slot while it waits on the user, then put it back at the front of the queue."""
+        self.active -= 1
+        job.admitted.clear()
+        self.admit_jobs()
         try:
-            last_reported_progress = 0
-            await telethon.download_media(message, file=original_file_path, progress_callback=progress_callback)
-        except Exception as e:
-            logging.error(f"An error occurred while downloading the file: {e}")
-            await update.message.reply_text(f"Failed to download the file: {e}")
+            yield
+        except BaseException:
+            # The job ends here without waiting for a slot, but run() still gives back the one it held
+            self.active += 1
+            raise
+        if self.stopping:
+            self.active += 1
+            raise asyncio.CancelledError()
+        jobs = self.queues.pop(job.user_id, collections.deque())
+        jobs.appendleft(job)
+        self.queues = {job.user_id: jobs, **self.queues}
+        self.admit_jobs()
+        try:
+            await job.admitted.wait()
+        except asyncio.CancelledError:
+            if self.withdraw(job):
+                self.active += 1
+            raise
+
+
+async def handle_file(job: Job) -> None:
+    """Download, extract and send one archive."""
+
+    async def progress_callback(current, total):
+        if job.file_size < MIN_PROGRESS_UPDATE_SIZE:
             return
+        progress = (current / total) * 100
+        rounded_progress = int(progress // 10 * 10)  # Round down to the nearest 10%
 
-        # Extract the contents
-        extracted_dir = os.path.join(TEMP_DIR, os.path.splitext(file_name)[0])
-        os.makedirs(extracted_dir, exist_ok=True)
-        context.user_data["file_name"] = file_name
-        context.user_data['original_file_path'] = original_file_path
-        context.user_data['extracted_dir'] = extracted_dir
-  
-
-        if file_name.endswith('.zip'):
-            # Attempt to extract ZIP file
-            with zipfile.ZipFile(original_file_path) as archive:
-                try:
-                    archive.testzip()  # Check if password is required
-                except RuntimeError as e:
-                    if "password" in e.args[0].lower():
-                        context.user_data['password'] = None
-                        return await ask_for_password(update, context)
-                archive.extractall(extracted_dir)
-        elif file_name.endswith('.rar'):
-            # Attempt to extract RAR file
-            with rarfile.RarFile(original_file_path) as archive:
-                if archive.needs_password():
-                    context.user_data['password'] = None
-                    return await ask_for_password(update, context)
-                archive.extractall(extracted_dir)
-        elif file_name.endswith('.7z'):
-            # Attempt to extract 7Z file
-            with py7zr.SevenZipFile(original_file_path, mode='r') as archive:
-                try:
-                    archive.list()  # Attempt to list the contents
-                except py7zr.exceptions.PasswordRequired:
-                    context.user_data['password'] = None
-                    return await ask_for_password(update, context)
-                archive.extractall(extracted_dir)
-        elif file_name.endswith('.gz'):
-            # Handle GZ files (no password support)
-            await extract_gzip(update, context, original_file_path, extracted_dir)
+        if rounded_progress > job.last_reported_progress:
+            job.last_reported_progress = rounded_progress
+            await job.reply(f"Download progress: {rounded_progress}%")
+
+    interrupted = False
+    try:
+        job.create_workspace()
+        if job_journal:
+            job_journal.update(job)
+        if job.resumes:
+            await job.reply(f"The bot was restarted while working on {job.file_name}. Picking up where it left off...")
         else:
-            await update.message.reply_text("Unsupported file format.")
+            await job.reply("Archive file received. Processing...")
+
+        if not job.downloaded:
+            message = await telethon.get_messages(job.chat_id, ids=job.message_id)
+            try:
+                async with job_scheduler.download_slots:
+                    with metrics.timer("download", job.archive_format) as timer:
+                        await download_archive(message, job.original_file_path, job.file_unique_id, progress_callback)
+                        timer.bytes_in = job.file_size
+            except Exception as e:
+                # The finished parts are kept, so sending the archive again resumes the download
+                logging.error(f"An error occurred while downloading the file: {e}")
+                job.park_partial_download()
+                await job.reply(f"Failed to download the file: {e}")
+                return
+            job.downloaded = True
+            if job_journal:
+                job_journal.update(job)
+
+        # Extract the contents
+        os.makedirs(job.extracted_dir, exist_ok=True)
+        # The probe reads the archive, so it runs in the extraction pool too
+        async with job_scheduler.extraction_slots:
+            with metrics.timer("probe", job.archive_format) as timer:
+                password_required = await run_extraction_job(needs_password, job.original_file_path)
+                timer.bytes_in = job.file_size
+        if password_required:
+            return await extract_with_password(job)
+        if not await choose_files(job):
             return
-        await send_extracted_files(update, context, extracted_dir)
+        await send_extracted_files(job)
+    except asyncio.CancelledError:
+        # The bot is shutting down: the journal keeps the job and its workspace for the next start
+        interrupted = True
+        raise
+    except UnsupportedArchive as e:
+        await job.reply(f"{job.file_name} uses a compression method or encryption that is not supported ({e}).")
     except Exception as e:
-        await update.message.reply_text(f"Failed to extract the archive: {e}")
-        cleanup(original_file_path, extracted_dir)
-        return
+        await job.reply(f"Failed to extract the archive: {e}")
+    finally:
+        if not interrupted:
+            cleanup(job)
+            if job_journal:
+                job_journal.finish(job)
+
+
+async def download_archive(message, file_path: str, file_unique_id: str, progress_callback) -> None:
+    """Download a document in DOWNLOAD_PART_SIZE parts, DOWNLOAD_CONNECTIONS at a time.
+
+    The parts are written into a preallocated file. Finished parts are recorded
+    in a .parts file next to it, so an interrupted download of the same document
+    resumes instead of starting again from byte 0.
+    """
+    file_size = message.document.size
+    state_path = file_path + ".parts"
+    part_count = max(1, -(-file_size // DOWNLOAD_PART_SIZE))
+    done_parts = load_download_state(state_path, file_unique_id) if os.path.exists(file_path) else None
+    if done_parts is None:
+        done_parts = set()
+        with open(file_path, 'wb') as out_file:
+            out_file.truncate(file_size)
+    todo = [part for part in range(part_count) if part not in done_parts]
+    downloaded = sum(min(DOWNLOAD_PART_SIZE, file_size - part * DOWNLOAD_PART_SIZE) for part in done_parts)
+
+    async def download_part(out_file, part):
+        offset = part * DOWNLOAD_PART_SIZE
+        length = min(DOWNLOAD_PART_SIZE, file_size - offset)
+        out_file.seek(offset)
+        async for chunk in telethon.iter_download(message.document, offset=offset, request_size=DOWNLOAD_REQUEST_SIZE,
+                                                  limit=-(-length // DOWNLOAD_REQUEST_SIZE), file_size=file_size):
+            out_file.write(chunk)
+
+    async def worker():
+        nonlocal downloaded
+        with open(file_path, 'r+b') as out_file:
+            while todo:
+                part = todo.pop(0)
+                await telegram_call(download_part, out_file, part, rate_limited=False)
+                out_file.flush()
+                done_parts.add(part)
+                save_download_state(state_path, file_unique_id, done_parts)
+                downloaded += min(DOWNLOAD_PART_SIZE, file_size - part * DOWNLOAD_PART_SIZE)
+                await progress_callback(downloaded, file_size)
+
+    await asyncio.gather(*[worker() for _ in range(min(DOWNLOAD_CONNECTIONS, len(todo)))])
+    remove_file(state_path)
+
+
+def load_download_state(state_path, file_unique_id):
+    """Return the parts already downloaded for this document, or None if the download has to start over."""
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+    if state.get("file_unique_id") != file_unique_id or state.get("part_size") != DOWNLOAD_PART_SIZE:
+        return None
+    return set(state["parts"])
+
+
+def save_download_state(state_path, file_unique_id, done_parts):
+    with open(state_path + ".tmp", 'w') as state_file:
+        json.dump({"file_unique_id": file_unique_id, "part_size": DOWNLOAD_PART_SIZE, "parts": sorted(done_parts)}, state_file)
+    os.replace(state_path + ".tmp", state_path)
 
 
     # Send extracted files
-async def send_extracted_files(update: Update, context: CallbackContext, extracted_dir: str) -> None:
-    retries = 3
+async def send_extracted_files(job: Job, password: str = None) -> None:
+    """Extract the archive one entry at a time and send each file as soon as it is ready.
+
+    Extraction runs in the extraction process pool and hands finished files over
+    through a bounded queue, so only a few extracted files sit on disk at any
+    moment. Files go to an UploadScheduler, which deletes each one once sent.
+    When every file was delivered, the sent file_ids are stored in the archive
+    cache so the same document can be answered without extracting it again.
+    """
     file_number = 0
-    original_file_path = context.user_data['original_file_path']
-    from_user = update.message.from_user
-    for root, dirs, files in os.walk(extracted_dir):
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
-        for file in files:
-            file_number += 1
-            file_path = os.path.join(root, file)
-            if not os.path.isfile(file_path) or file.startswith('.') or os.path.getsize(file_path) == 0:  
+    entries, cancelled = extraction_channel()
+    await job_scheduler.extraction_slots.acquire()
+    # Members delivered before a restart are not extracted again
+    file_filter = ResumeFilter(job.file_filter, job.sent_members) if job.sent_members else job.file_filter
+    extraction = run_extraction_job(extract_entries, job.original_file_path, job.extracted_dir, password, file_filter,
+                                    entries, cancelled)
+    extraction.add_done_callback(lambda _: job_scheduler.extraction_slots.release())
+    try:
+        async with job_scheduler.upload_slots:
+            uploads = UploadScheduler(job)
+            bundler = FileBundler(job, uploads) if BUNDLE_FILE_SIZE else None
+            try:
+                while True:
+                    entry = await next_entry(entries, extraction)
+                    if entry[0] == "done":
+                        break
+                    if entry[0] == "error":
+                        raise ARCHIVE_ERRORS.get(entry[2], RuntimeError)(entry[1])
+                    if entry[0] == "progress":
+                        if job.file_size >= MIN_PROGRESS_UPDATE_SIZE:
+                            await job.reply(f"Extraction progress: {entry[1]}%")
+                        continue
+                    file_number += 1
+                    _, file_path, digest = entry
+                    if os.path.getsize(file_path) == 0:
+                        remove_file(file_path)
+                        continue
+                    if bundler and await bundler.add(file_path, file_number, digest):
+                        continue
+                    await uploads.add(file_path, file_number, digest)
+            except asyncio.CancelledError:
+                # Shutting down: the files still queued are sent when the job is resumed
+                await uploads.abort()
+                raise
+            finally:
+                try:
+                    if bundler and not uploads.aborted:
+                        await bundler.close()
+                except asyncio.CancelledError:
+                    await uploads.abort()
+                    raise
+                finally:
+                    await uploads.close()
+    finally:
+        try:
+            cancelled.set()
+        except (OSError, EOFError):
+            pass  # The manager died along with the worker
+        extraction_stats = await extraction
+    if extraction_stats:
+        busy_seconds, bytes_out = extraction_stats
+        metrics.observe("extraction", job.archive_format, busy_seconds, job.file_size, bytes_out)
+    # Filtered or resumed results only hold part of the archive, so they are not cached
+    if (archive_cache and uploads.complete and not job.file_filter and not job.sent_members
+            and (not password or CACHE_PASSWORD_PROTECTED_ARCHIVES)):
+        archive_cache.put(job.file_unique_id, uploads.sent_groups)
+    await job.reply("Extraction complete!")
+
+
+class TokenBucket:
+    """Rate limiter shared by every job that sends messages.
+
+    A flood wait reported by Telegram empties the bucket and blocks all callers
+    until it has passed.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+async def telegram_call(func, *args, rate_limited=True, **kwargs):
+    """Call the Telegram API, honouring flood waits and retrying network errors with exponential backoff."""
+    delay = RETRY_BASE_DELAY
+    for attempt in range(1, SEND_RETRIES + 1):
+        if rate_limited:
+            await send_limiter.acquire()
+        try:
+            return await func(*args, **kwargs)
+        except FloodWaitError as e:
+            wait = e.seconds
+            send_limiter.block(wait)
+            metrics.count("flood_waits")
+            metrics.count("flood_wait_seconds", wait)
+            logging.warning(f"Flood wait of {wait} seconds requested by Telegram (attempt {attempt}/{SEND_RETRIES})")
+        except error.RetryAfter as e:
+            wait = e.retry_after
+            send_limiter.block(wait)
+            metrics.count("flood_waits")
+            metrics.count("flood_wait_seconds", wait)
+            logging.warning(f"Flood wait of {wait} seconds requested by Telegram (attempt {attempt}/{SEND_RETRIES})")
+        except (error.NetworkError, ServerError, ConnectionError, asyncio.TimeoutError) as e:
+            if attempt == SEND_RETRIES:
+                raise
+            wait = delay
+            delay *= 2
+            metrics.count("network_errors")
+            logging.warning(f"Network error while talking to Telegram, retrying in {wait} seconds... (attempt {attempt}/{SEND_RETRIES}): {e}")
+        if attempt < SEND_RETRIES:
+            metrics.count("retries")
+            await asyncio.sleep(wait)
+    raise RuntimeError(f"Still flood limited after {SEND_RETRIES} attempts")
+
+
+class PendingFile:
+    """An extracted file on its way to the chat."""
+
+    def __init__(self, file_path, file_number, digest, members):
+        self.file_path = file_path
+        self.file_number = file_number
+        self.digest = digest
+        self.members = members  # Archive members in the file, recorded in the job journal once it is sent
+        self.file_id = file_id_cache.get(digest) if file_id_cache else None
+        self.upload = None
+        self.size = 0
+
+    async def media(self):
+        """The cached file_id, or the uploaded file once its upload has finished."""
+        return self.file_id or await self.upload
+
+
+class UploadScheduler:
+    """Uploads extracted files with several transfers in flight and sends them in archive order.
+
+    Up to UPLOAD_CONCURRENCY files upload at once. A file keeps its pending slot
+    and its share of UPLOAD_BUFFER_SIZE until its message has been sent, which
+    bounds the extracted files waiting on disk by count and by bytes. With
+    ALBUM_MODE on, consecutive photos and videos are sent as media groups of up
+    to ALBUM_SIZE. Files already in the file_id cache are sent by file_id
+    without being uploaded again.
+    """
+
+    FLUSH = object()  # Queued to make the sender send the album it is collecting
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.chat_id = job.chat_id
+        self.upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        self.pending = asyncio.Semaphore(UPLOAD_CONCURRENCY + ALBUM_SIZE)
+        self.pending_bytes = 0
+        self.room_freed = asyncio.Event()
+        self.uploads = asyncio.Queue()
+        self.sent_groups = []  # file_ids of every message sent, grouped by album, for the archive cache
+        self.complete = True
+        self.aborted = False
+        self.upload_tasks = set()
+        self.sender = asyncio.create_task(self.send_uploads())
+
+    async def add(self, file_path, file_number, digest=None, members=None):
+        """Start uploading a file, waiting for a free slot first."""
+        await self.pending.acquire()
+        size = os.path.getsize(file_path)
+        flushed = False
+        while self.pending_bytes and self.pending_bytes + size > UPLOAD_BUFFER_SIZE:
+            if not flushed:
+                # An album being collected would otherwise wait for this file while this file waits for the album
+                self.uploads.put_nowait(self.FLUSH)
+                flushed = True
+            self.room_freed.clear()
+            await self.room_freed.wait()
+        self.pending_bytes += size
+        if members is None:
+            members = [os.path.relpath(file_path, self.job.extracted_dir)]
+        pending_file = PendingFile(file_path, file_number, digest, members)
+        pending_file.size = size
+        if pending_file.file_id:
+            metrics.count("file_id_cache_hits")
+        else:
+            await self.start_upload(pending_file)
+        self.uploads.put_nowait(pending_file)
+
+    async def close(self):
+        """Wait until every queued file has been sent."""
+        if self.aborted:
+            return
+        self.uploads.put_nowait(None)
+        try:
+            await self.sender
+        except asyncio.CancelledError:
+            await self.abort()
+            raise
+
+    async def abort(self):
+        """Stop sending and uploading right away, leaving the queued files unsent."""
+        self.aborted = True
+        tasks = [self.sender, *self.upload_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def start_upload(self, pending_file):
+        await self.upload_slots.acquire()
+        pending_file.upload = asyncio.create_task(self.upload(pending_file.file_path))
+        self.upload_tasks.add(pending_file.upload)
+        pending_file.upload.add_done_callback(self.upload_tasks.discard)
+
+    async def upload(self, file_path):
+        try:
+            with metrics.timer("upload", self.job.archive_format) as timer:
+                timer.bytes_out = os.path.getsize(file_path)
+                return await telegram_call(telethon.upload_file, file_path, part_size_kb=UPLOAD_PART_SIZE_KB, rate_limited=False)
+        finally:
+            self.upload_slots.release()
+
+    async def send_uploads(self):
+        pending_file = await self.uploads.get()
+        while pending_file is not None:
+            if pending_file is self.FLUSH:
+                pending_file = await self.uploads.get()
                 continue
-            if file.lower().endswith(('jpg', 'jpeg', 'png', 'gif')):
-                    for attempt in range(retries):
-                        try:
-                            with open(file_path, 'rb') as photo:
-                                await update.message.reply_photo(photo=photo)
-                                break
-                        except error.TimedOut as e:
-                            logging.warning(f"Timed out while sending message, retrying... (attempt {attempt + 1}/{retries})")
-                            await update.message.reply_text(f"File {file_number}: A timeout error occurred while sending the photo. (attempt {attempt + 1}/{retries})")
-                            if attempt == retries - 1:
-                                await update.message.reply_text(f"File {file_number}: A timeout error occurred while sending the photo. Attempting next file...")
-                                logging.error(f"Failed to send message after {retries} attempts: {e}")
-                                continue
-                        except error.NetworkError as e:
-                            logging.warning(f"Network error while sending message, retrying... (attempt {attempt + 1}/{retries})")
-                            await update.message.reply_text(f"File {file_number}: A network error occurred while sending the photo. (attempt {attempt + 1}/{retries})")
-                            if attempt == retries - 1:
-                                logging.error(f"Failed to send message after {retries} attempts: {e}")
-                                await update.message.reply_text(f"File {file_number}: A network error occurred while sending the photo. Attempting next file...")
-                                continue
-                        except Exception as e:
-                            logging.error(f"An error occurred while sending the photo: {e}")
-                            await update.message.reply_text(f"File {file_number}: An error occurred while sending the photo. (attempt {attempt + 1}/{retries})")
-                            if attempt == retries - 1:
-                                logging.error(f"Failed to send message after {retries} attempts: {e}")
-                                await update.message.reply_text(f"File {file_number}: An error occurred while sending the photo. Attempting next file...")
-                                continue
-            elif file.lower().endswith(('mp4', 'mov')):
-                    for attempt in range(retries):
-                        try:
-                            with open(file_path, 'rb') as video:
-                                await telethon.send_file(from_user.id, video)
-                                break
-                        except error.TimedOut as e:
-                            logging.warning(f"Timed out while sending message, retrying... (attempt {attempt + 1}/{retries})")
-                            await update.message.reply_text(f"File {file_number}: A timeout error occurred while sending the video. (attempt {attempt + 1}/{retries})")
-                            if attempt == retries - 1:
-                                await update.message.reply_text(f"File {file_number}: A timeout error occurred while sending the video. Attempting next file...")
-                                logging.error(f"Failed to send message after {retries} attempts: {e}")
-                                continue
-                        except error.NetworkError as e:
-                            logging.warning(f"Network error while sending message, retrying... (attempt {attempt + 1}/{retries})")
-                            await update.message.reply_text(f"File {file_number}: A network error occurred while sending the video. (attempt {attempt + 1}/{retries})")
-                            if attempt == retries - 1:
-                                logging.error(f"Failed to send message after {retries} attempts: {e}")
-                                await update.message.reply_text(f"File {file_number}: A network error occurred while sending the video. Attempting next file...")
-                                continue
-                        except Exception as e:
-                            logging.error(f"An error occurred while sending the video: {e}")
-                            await update.message.reply_text(f"File {file_number}: An error occurred while sending the video. (attempt {attempt + 1}/{retries})")
-                            if attempt == retries - 1:
-                                logging.error(f"Failed to send message after {retries} attempts: {e}")
-                                await update.message.reply_text(f"File {file_number}: An error occurred while sending the video. Attempting next file...")
-                                continue
-            else:
-                # Send as a regular file
-                for attempt in range(retries):
-                    try:
-                        with open(file_path, 'rb') as document:
-                            await telethon.send_file(from_user.id, document)
-                            break
-                    except error.TimedOut as e:
-                        logging.warning(f"Timed out while sending message, retrying... (attempt {attempt + 1}/{retries})")
-                        await update.message.reply_text(f"File {file_number}: A timeout error occurred while sending the file. (attempt {attempt + 1}/{retries})")
-                        if attempt == retries - 1:
-                            await update.message.reply_text(f"File {file_number}: A timeout error occurred while sending the file. Attempting next file...")
-                            logging.error(f"Failed to send message after {retries} attempts: {e}")
-                            continue
-                    except error.NetworkError as e:
-                        logging.warning(f"Network error while sending message, retrying... (attempt {attempt + 1}/{retries})")
-                        await update.message.reply_text(f"File {file_number}: A network error occurred while sending the file. (attempt {attempt + 1}/{retries})")
-                        if attempt == retries - 1:
-                            logging.error(f"Failed to send message after {retries} attempts: {e}")
-                            await update.message.reply_text(f"File {file_number}: A network error occurred while sending the file. Attempting next file...")
-                            continue
-                    except Exception as e:
-                        logging.error(f"An error occurred while sending the video: {e}")
-                        await update.message.reply_text(f"File {file_number}: An error occurred while sending the file. (attempt {attempt + 1}/{retries})")
-                        if attempt == retries - 1:
-                            logging.error(f"Failed to send message after {retries} attempts: {e}")
-                            await update.message.reply_text(f"File {file_number}: An error occurred while sending the file. Attempting next file...")
-                            continue
-    # Cleanup
-    cleanup(original_file_path, extracted_dir)
-    await update.message.reply_text("Extraction complete!")
-
-
-def cleanup(original_file_path, extracted_dir):
-    if os.path.exists(original_file_path):
+            if not (ALBUM_MODE and is_album_media(pending_file.file_path)):
+                await self.send_single(pending_file)
+                pending_file = await self.uploads.get()
+                continue
+            # Collect the run of media that follows into one album
+            album = [pending_file]
+            pending_file = await self.uploads.get()
+            while (pending_file is not None and pending_file is not self.FLUSH and len(album) < ALBUM_SIZE
+                   and is_album_media(pending_file.file_path)):
+                album.append(pending_file)
+                pending_file = await self.uploads.get()
+            await self.send_album(album)
+
+    async def send_album(self, album):
+        if len(album) == 1:
+            return await self.send_single(album[0])
         try:
-            os.remove(original_file_path)
+            media = [await pending_file.media() for pending_file in album]
+            messages = await telegram_call(telethon.send_file, self.chat_id, media)
         except Exception as e:
-            pass
+            logging.warning(f"Failed to send an album of {len(album)} files, sending them one by one: {e}")
+            for pending_file in album:
+                await self.send_single(pending_file)
+            return
+        self.record_sent(album, messages)
+        for pending_file in album:
+            self.file_sent(pending_file)
 
-    for root, dirs, files in os.walk(extracted_dir, topdown=False):
-        for name in files:
-            file_path = os.path.join(root, name)
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                except Exception as e:
-                    pass
+    async def send_single(self, pending_file):
+        file_path = pending_file.file_path
+        # Telegram rejects photos over the size limit, but takes them as documents
+        force_document = file_path.lower().endswith(PHOTO_EXTENSIONS) and os.path.getsize(file_path) > PHOTO_SIZE_LIMIT
+        try:
+            try:
+                message = await telegram_call(telethon.send_file, self.chat_id, await pending_file.media(), force_document=force_document)
+            except Exception as e:
+                if not pending_file.file_id:
+                    raise
+                # The cached file_id was not accepted, so upload the file after all
+                logging.warning(f"Cached file_id for {os.path.basename(file_path)} was rejected, uploading instead: {e}")
+                file_id_cache.discard(pending_file.digest)
+                pending_file.file_id = None
+                await self.start_upload(pending_file)
+                message = await telegram_call(telethon.send_file, self.chat_id, await pending_file.media(), force_document=force_document)
+            self.record_sent([pending_file], [message])
+        except Exception as e:
+            self.complete = False
+            logging.error(f"Failed to send file {pending_file.file_number} ({os.path.basename(file_path)}): {e}")
+            try:
+                await self.job.reply(f"File {pending_file.file_number}: Failed to send {os.path.basename(file_path)}. Attempting next file...")
+            except Exception as e:
+                logging.error(f"An error occurred while replying: {e}")
+        finally:
+            self.file_sent(pending_file)
 
-        for name in dirs:
-            dir_path = os.path.join(root, name)
-            if os.path.exists(dir_path):
-                try:
-                    os.rmdir(dir_path)
-                except Exception as e:
-                    pass
+    def record_sent(self, pending_files, messages):
+        """Remember the file_ids of sent messages for the file_id and archive caches."""
+        if not self.sent_groups:
+            metrics.observe("first_file", self.job.archive_format, time.monotonic() - self.job.started)
+        group = []
+        for pending_file, message in zip(pending_files, messages):
+            file_id = pending_file.file_id or telethon_utils.pack_bot_file_id(message.media)
+            if not file_id:
+                self.complete = False
+                continue
+            if file_id_cache and pending_file.digest and not pending_file.file_id:
+                file_id_cache.put(pending_file.digest, file_id)
+            group.append(file_id)
+        self.sent_groups.append(group)
+        if job_journal:
+            job_journal.mark_sent(self.job, [member for pending_file in pending_files for member in pending_file.members])
+
+    def file_sent(self, pending_file):
+        remove_file(pending_file.file_path)
+        self.pending_bytes -= pending_file.size
+        self.room_freed.set()
+        self.pending.release()
+
+
+class FileBundler:
+    """Packs small files that are not photos or videos into store-only zips, sent as a few documents.
+
+    Files under BUNDLE_FILE_SIZE are held back until BUNDLE_MIN_FILES of them
+    have turned up; from then on they go into a bundle, which is handed to the
+    UploadScheduler whenever the next file would take it past BUNDLE_MAX_SIZE,
+    and once extraction is done. Archives with fewer small files get them one
+    by one as before. Bundles are not compressed, since the files were just
+    decompressed and repacking should cost no more than copying them.
+    """
+
+    def __init__(self, job: Job, uploads: UploadScheduler):
+        self.job = job
+        self.uploads = uploads
+        # Hidden members are never extracted, so this cannot clash with a directory from the archive
+        self.bundle_dir = os.path.join(job.extracted_dir, ".bundles")
+        self.held = []  # (file_path, file_number, digest) of small files until there are BUNDLE_MIN_FILES
+        self.bundling = False
+        self.bundle = None
+        self.bundle_number = 0
+        self.bundle_size = 0
+        self.bundle_members = []
+        self.bundles = 0
+
+    async def add(self, file_path, file_number, digest) -> bool:
+        """Take a file for bundling. Returns False if it should be sent on its own."""
+        if os.path.getsize(file_path) >= BUNDLE_FILE_SIZE or media_type(file_path):
+            return False
+        if self.bundling:
+            await self.pack(file_path, file_number)
+            return True
+        self.held.append((file_path, file_number, digest))
+        if len(self.held) >= BUNDLE_MIN_FILES:
+            self.bundling = True
+            for held_path, held_number, _ in self.held:
+                await self.pack(held_path, held_number)
+            self.held = []
+        return True
+
+    async def pack(self, file_path, file_number):
+        member_name = os.path.relpath(file_path, self.job.extracted_dir)
+        entry_size = os.path.getsize(file_path) + ZIP_ENTRY_OVERHEAD + 2 * len(member_name.encode())
+        if self.bundle and self.bundle_size + entry_size > BUNDLE_MAX_SIZE:
+            await self.send_bundle()
+        if not self.bundle:
+            self.bundles += 1
+            os.makedirs(self.bundle_dir, exist_ok=True)
+            stem = os.path.splitext(self.job.file_name)[0]
+            bundle_path = os.path.join(self.bundle_dir, f"{stem} (files {self.bundles}).zip")
+            self.bundle = zipfile.ZipFile(bundle_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+            self.bundle_number = file_number
+        await asyncio.to_thread(self.bundle.write, file_path, member_name)
+        remove_file(file_path)
+        self.bundle_size += entry_size
+        self.bundle_members.append(member_name)
+
+    async def send_bundle(self):
+        bundle, self.bundle = self.bundle, None
+        await asyncio.to_thread(bundle.close)
+        metrics.count("bundled_files", len(self.bundle_members), format=self.job.archive_format)
+        metrics.count("bundles", format=self.job.archive_format)
+        members, self.bundle_members = self.bundle_members, []
+        self.bundle_size = 0
+        # Bundles are never identical twice (they hold extraction times), so they get no digest for the file_id cache
+        await self.uploads.add(bundle.filename, self.bundle_number, members=members)
 
-    if os.path.exists(extracted_dir):
+    async def close(self):
+        """Send the last bundle, or the held files if there were too few to bundle."""
+        if self.bundle:
+            await self.send_bundle()
+        for file_path, file_number, digest in self.held:
+            await self.uploads.add(file_path, file_number, digest)
+        self.held = []
+
+
+async def send_cached_archive(job: Job) -> bool:
+    """Re-send the results of an archive that was unpacked before. Returns False if there is nothing usable cached."""
+    sent_groups = archive_cache.get(job.file_unique_id)
+    if sent_groups is None:
+        return False
+    metrics.count("archive_cache_hits")
+    await job.reply("This archive was unpacked before. Sending its files again...")
+    for group in sent_groups:
         try:
-            os.rmdir(extracted_dir)
+            await telegram_call(telethon.send_file, job.chat_id, group if len(group) > 1 else group[0])
+        except Exception as e:
+            # Fall back to unpacking the archive; the resulting files replace the stale entry
+            logging.warning(f"Failed to re-send cached archive {job.file_unique_id}, unpacking it again: {e}")
+            archive_cache.discard(job.file_unique_id)
+            return False
+    await job.reply("Extraction complete!")
+    return True
+
+
+class FileIdCache:
+    """Persistent map from the SHA-256 of an extracted file to the Telegram file_id of its first upload.
+
+    Stored in SQLite and capped at max_entries, evicting the least recently used.
+    """
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS file_ids (digest TEXT PRIMARY KEY, file_id TEXT NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used)")
+        self.db.commit()
+
+    def get(self, digest):
+        row = self.db.execute("SELECT file_id FROM file_ids WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE file_ids SET last_used = ? WHERE digest = ?", (time.time(), digest))
+        self.db.commit()
+        return row[0]
+
+    def put(self, digest, file_id):
+        self.db.execute("INSERT OR REPLACE INTO file_ids (digest, file_id, last_used) VALUES (?, ?, ?)", (digest, file_id, time.time()))
+        self.db.execute("DELETE FROM file_ids WHERE digest IN (SELECT digest FROM file_ids ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.db.commit()
+
+    def discard(self, digest):
+        self.db.execute("DELETE FROM file_ids WHERE digest = ?", (digest,))
+        self.db.commit()
+
+
+class ArchiveCache:
+    """Persistent map from an archive document's file_unique_id to the file_ids sent for it.
+
+    The file_ids are stored as JSON, grouped the way they were sent (a group of
+    several is an album). Entries expire after ttl seconds and at most
+    max_entries are kept, evicting the least recently used.
+    """
+
+    def __init__(self, path, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS archives (file_unique_id TEXT PRIMARY KEY, sent_groups TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+        self.db.commit()
+
+    def get(self, file_unique_id):
+        self.db.execute("DELETE FROM archives WHERE created < ?", (time.time() - self.ttl,))
+        row = self.db.execute("SELECT sent_groups FROM archives WHERE file_unique_id = ?", (file_unique_id,)).fetchone()
+        if row is not None:
+            self.db.execute("UPDATE archives SET last_used = ? WHERE file_unique_id = ?", (time.time(), file_unique_id))
+        self.db.commit()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, file_unique_id, sent_groups):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO archives (file_unique_id, sent_groups, created, last_used) VALUES (?, ?, ?, ?)", (file_unique_id, json.dumps(sent_groups), now, now))
+        self.db.execute("DELETE FROM archives WHERE file_unique_id IN (SELECT file_unique_id FROM archives ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.db.commit()
+
+    def discard(self, file_unique_id):
+        self.db.execute("DELETE FROM archives WHERE file_unique_id = ?", (file_unique_id,))
+        self.db.commit()
+
+
+class JobJournal:
+    """Persistent record of unfinished jobs, so they can pick up where they were after a restart.
+
+    Stored in SQLite: one row per job with what it needs to start again (the
+    message, its workspace, whether the archive is fully downloaded and the
+    chosen filter), plus the archive members already delivered. Passwords are
+    not stored, so a resumed protected archive asks for its password again. A
+    job's rows are deleted when it finishes.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+                        "message_id INTEGER NOT NULL, file_name TEXT NOT NULL, file_size INTEGER NOT NULL, file_unique_id TEXT NOT NULL, "
+                        "workspace TEXT, downloaded INTEGER NOT NULL DEFAULT 0, file_filter TEXT, resumes INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sent_members (job_id INTEGER NOT NULL, member TEXT NOT NULL, PRIMARY KEY (job_id, member))")
+        self.db.commit()
+
+    def add(self, job):
+        cursor = self.db.execute(
+            "INSERT INTO jobs (chat_id, user_id, message_id, file_name, file_size, file_unique_id, file_filter, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.chat_id, job.user_id, job.message_id, job.file_name, job.file_size, job.file_unique_id, self.encode_filter(job), time.time()))
+        self.db.commit()
+        job.journal_id = cursor.lastrowid
+
+    def update(self, job):
+        if job.journal_id is None:
+            return
+        self.db.execute("UPDATE jobs SET workspace = ?, downloaded = ?, file_filter = ? WHERE id = ?",
+                        (job.workspace, job.downloaded, self.encode_filter(job), job.journal_id))
+        self.db.commit()
+
+    def mark_sent(self, job, members):
+        if job.journal_id is None:
+            return
+        self.db.executemany("INSERT OR IGNORE INTO sent_members (job_id, member) VALUES (?, ?)", [(job.journal_id, member) for member in members])
+        self.db.commit()
+
+    def finish(self, job):
+        if job.journal_id is None:
+            return
+        self.db.execute("DELETE FROM sent_members WHERE job_id = ?", (job.journal_id,))
+        self.db.execute("DELETE FROM jobs WHERE id = ?", (job.journal_id,))
+        self.db.commit()
+
+    def unfinished(self):
+        """Rebuild the jobs still in the journal, oldest first, counting this as one more resume for each."""
+        self.db.execute("UPDATE jobs SET resumes = resumes + 1")
+        self.db.commit()
+        jobs = []
+        for row in self.db.execute("SELECT id, chat_id, user_id, message_id, file_name, file_size, file_unique_id, workspace, downloaded, "
+                                   "file_filter, resumes FROM jobs ORDER BY id").fetchall():
+            job = Job(*row[1:7])
+            job.journal_id = row[0]
+            if row[7]:
+                job.use_workspace(row[7])
+            job.downloaded = bool(row[8])
+            if row[9] is not None:
+                job.filter_chosen = True
+                job.file_filter = FileFilter(**json.loads(row[9])) if row[9] != "{}" else None
+            job.resumes = row[10]
+            job.sent_members = {member for member, in self.db.execute("SELECT member FROM sent_members WHERE job_id = ?", (job.journal_id,))}
+            jobs.append(job)
+        return jobs
+
+    def workspaces(self):
+        """Workspaces of the unfinished jobs, which the startup sweep must leave for them."""
+        return {os.path.abspath(workspace) for workspace, in self.db.execute("SELECT workspace FROM jobs WHERE workspace IS NOT NULL")}
+
+    @staticmethod
+    def encode_filter(job):
+        """The filter as JSON: NULL while none was chosen, "{}" for all files."""
+        if not job.filter_chosen:
+            return None
+        return json.dumps(vars(job.file_filter) if job.file_filter else {})
+
+
+def is_album_media(file_path):
+    """Return True for photos and videos that can go into a media group."""
+    name = file_path.lower()
+    if name.endswith(PHOTO_EXTENSIONS):
+        return os.path.getsize(file_path) <= PHOTO_SIZE_LIMIT
+    return name.endswith(VIDEO_EXTENSIONS)
+
+
+def media_type(member_name):
+    """Return "photo", "video" or "audio" for media by file extension, else None."""
+    name = member_name.lower()
+    if name.endswith(PHOTO_EXTENSIONS + OTHER_PHOTO_EXTENSIONS):
+        return "photo"
+    if name.endswith(VIDEO_EXTENSIONS + OTHER_VIDEO_EXTENSIONS):
+        return "video"
+    if name.endswith(AUDIO_EXTENSIONS):
+        return "audio"
+    return None
+
+
+class FileFilter:
+    """Which archive members the user wants, parsed from text such as "media", "*.pdf docs/*" or "<20MB".
+
+    Terms are separated by spaces. "media" keeps photos, videos and audio, "<SIZE" (KB, MB or GB) skips larger
+    files and anything else is a path glob; a member is kept if it matches any of the globs. Sent to the
+    extraction pool, so it has to stay picklable.
+    """
+
+    SIZE_UNITS = {"": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3}
+    SIZE_TERM = r"<=?(\d+(?:\.\d+)?)(kb|mb|gb)?"
+    CAPTION_PREFIX = "filter:"
+
+    def __init__(self, media_only=False, globs=(), max_size=None):
+        self.media_only = media_only
+        self.globs = tuple(globs)
+        self.max_size = max_size
+
+    @classmethod
+    def parse(cls, text):
+        """Return a FileFilter for text, or None if it asks for all files."""
+        text = text.strip().lower()
+        if text in ("", "all", "all files"):
+            return None
+        if text == "media only":
+            text = "media"
+        media_only, globs, max_size = False, [], None
+        for term in text.split():
+            size = re.fullmatch(cls.SIZE_TERM, term)
+            if term == "media":
+                media_only = True
+            elif size:
+                max_size = int(float(size.group(1)) * cls.SIZE_UNITS[size.group(2) or ""])
+            else:
+                globs.append(term)
+        return cls(media_only, globs, max_size)
+
+    @classmethod
+    def from_caption(cls, caption):
+        """Return the FileFilter an archive's caption asks for, or None if the caption is not a filter.
+
+        Captions are usually just text, so one only counts as a filter when it starts with "filter:"
+        or when every term is clearly a filter term: "media", a size limit or a glob with *?[ or /.
+        """
+        text = caption.strip().lower()
+        if text.startswith(cls.CAPTION_PREFIX):
+            return cls.parse(text[len(cls.CAPTION_PREFIX):])
+        terms = text.split()
+        if terms and all(term == "media" or re.fullmatch(cls.SIZE_TERM, term) or re.search(r"[*?\[/]", term)
+                         for term in terms):
+            return cls.parse(text)
+        return None
+
+    def matches(self, member_name, size):
+        if self.media_only and not media_type(member_name):
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        name = member_name.replace('\\', '/').lower()
+        return not self.globs or any(fnmatch.fnmatchcase(name, glob) for glob in self.globs)
+
+    def __str__(self):
+        terms = (["media"] if self.media_only else []) + list(self.globs)
+        if self.max_size is not None:
+            terms.append(f"up to {format_size(self.max_size)}")
+        return ", ".join(terms)
+
+
+class ResumeFilter:
+    """Skips the members a resumed job delivered before the restart, on top of the user's FileFilter."""
+
+    def __init__(self, file_filter, sent_members):
+        self.file_filter = file_filter
+        self.sent_members = frozenset(sent_members)
+
+    def matches(self, member_name, size):
+        if os.path.normpath(member_name.replace('\\', '/').lstrip('/')) in self.sent_members:
+            return False
+        return not self.file_filter or self.file_filter.matches(member_name, size)
+
+
+def remove_file(file_path):
+    if os.path.exists(file_path):
+        try:
+            os.remove(file_path)
         except Exception as e:
             pass
 
 
-async def extract_gzip(update: Update, context: CallbackContext, file_path: str, output_dir: str) -> None:
-    """Extract .gz files."""
-    base_name = os.path.basename(file_path)
-    output_file = os.path.join(output_dir, os.path.splitext(base_name)[0])  # Remove .gz extension
-    with gzip.open(file_path, 'rb') as gz_file, open(output_file, 'wb') as out_file:
-        out_file.write(gz_file.read())
+def cleanup(job: Job) -> None:
+    """Delete the job's workspace in a background thread, so removing a big tree does not stall the bot."""
+    if job.workspace:
+        asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, job.workspace, True)
 
-    # If the decompressed file is a tarball, extract it
-    if tarfile.is_tarfile(output_file):
-        with tarfile.open(output_file, 'r') as tar:
+
+def path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def sweep_workspaces(keep=()):
+    """Reclaim what earlier runs left behind in TEMP_DIR, PARTIAL_DIR and RAM_TEMP_DIR.
+
+    Workspaces and partial downloads older than WORKSPACE_TTL are deleted, then
+    the oldest remaining ones until the total fits in TEMP_DIR_QUOTA. Only job
+    workspaces and the contents of PARTIAL_DIR are touched, as RAM_TEMP_DIR may
+    be shared with other programs. The workspaces in keep (those of journaled
+    jobs, about to be resumed) count toward the quota but are never deleted.
+    """
+    leftovers = []
+    for root in (TEMP_DIR, PARTIAL_DIR, RAM_TEMP_DIR):
+        if not root or not os.path.isdir(root):
+            continue
+        for entry in os.scandir(root):
+            if root != PARTIAL_DIR and not entry.name.startswith(WORKSPACE_PREFIX):
+                continue
             try:
-                tar.extractall(output_dir)
-            except tarfile.ReadError as e:
-                if "password" in str(e).lower():
-                    await update.message.reply_text("This tarball is password-protected. Please provide the password:")
-                    context.user_data['password'] = None
-                    context.user_data['output_file'] = output_file
-                    context.user_data['output_dir'] = output_dir
-                    return await ask_for_password(update, context)
+                leftovers.append((entry.stat().st_mtime, path_size(entry.path), entry.path))
+            except OSError:
+                pass
+    leftovers.sort()
+    now = time.time()
+    total = sum(size for _, size, _ in leftovers)
+    removed = 0
+    for mtime, size, path in leftovers:
+        if os.path.abspath(path) in keep:
+            continue
+        if now - mtime < WORKSPACE_TTL and (not TEMP_DIR_QUOTA or total <= TEMP_DIR_QUOTA):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            remove_file(path)
+        total -= size
+        removed += 1
+    if removed:
+        logging.info(f"Removed {removed} leftover workspaces and downloads, {total} bytes of temp files remain")
 
-        await send_extracted_files(update, context, output_dir)
-        os.remove(output_file)  # Clean up the tarball
 
+# Decompression is CPU-bound, so it runs in separate processes to keep the bot responsive.
+# Spawned workers start clean instead of inheriting the client threads.
+extraction_context = multiprocessing.get_context("spawn")
 
-async def ask_for_password(update: Update, context: CallbackContext) -> int:
-    """Prompt the user for a password."""
-    await update.message.reply_text("This archive is password-protected. Please provide the password:")
-    return WAITING_FOR_PASSWORD
 
+def start_extraction_pool():
+    global extraction_pool
+    extraction_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=extraction_context,
+                                          initializer=configure_worker_logging)
 
-async def receive_password(update: Update, context: CallbackContext) -> int:
-    """Receive the password from the user."""
-    retries = 3
-    password = update.message.text
-    context.user_data['password'] = password
-    file_name = context.user_data['file_name']
 
-    original_file_path = context.user_data['original_file_path']
-    extracted_dir = context.user_data['extracted_dir']
-    for attempt in range(retries):
+def restart_broken_pool(pool):
+    """Replace the extraction pool after a worker died (e.g. killed for running out of memory).
+
+    A ProcessPoolExecutor refuses all work once one of its workers is gone, so
+    without this every later job would fail until the bot restarts.
+    """
+    if pool is not extraction_pool:
+        return  # Another job already replaced it
+    logging.error("An extraction worker died, restarting the extraction pool")
+    metrics.count("extraction_pool_restarts")
+    pool.shutdown(wait=False, cancel_futures=True)
+    start_extraction_pool()
+
+
+def run_extraction_job(func, *args):
+    """Run a blocking extraction job in the extraction process pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    pool = extraction_pool
+    try:
+        future = loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        restart_broken_pool(pool)
+        pool = extraction_pool
+        future = loop.run_in_executor(pool, func, *args)
+
+    def check_pool(future):
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            restart_broken_pool(pool)
+
+    future.add_done_callback(check_pool)
+    return future
+
+
+def extraction_channel():
+    """A bounded queue and a cancel flag shared with an extraction worker, restarting the manager if it died."""
+    global extraction_manager
+    try:
+        return extraction_manager.Queue(maxsize=EXTRACT_QUEUE_SIZE), extraction_manager.Event()
+    except (OSError, EOFError) as e:
+        logging.error(f"The multiprocessing manager is gone ({e!r}), starting a new one")
+        extraction_manager = extraction_context.Manager()
+        return extraction_manager.Queue(maxsize=EXTRACT_QUEUE_SIZE), extraction_manager.Event()
+
+
+async def next_entry(entries, extraction):
+    """Wait for the next entry from the extraction worker, giving up if the worker ended without one.
+
+    The worker always finishes with ("done",) or ("error", ...), so an empty
+    queue after its future has completed means it died mid-extraction.
+    """
+    while True:
+        try:
+            return await asyncio.to_thread(entries.get, timeout=ENTRY_POLL_INTERVAL)
+        except queue.Empty:
+            if extraction.done():
+                exception = None if extraction.cancelled() else extraction.exception()
+                raise RuntimeError(f"The extraction worker stopped unexpectedly: {exception or 'no result'}")
+
+
+class ExtractionCancelled(Exception):
+    """Raised inside the extraction worker when the consumer has stopped reading."""
+
+
+class WrongPassword(RuntimeError):
+    """Raised when extraction fails because a member is not encrypted with the given password."""
+
+
+class UnsupportedArchive(RuntimeError):
+    """Raised when the archive uses a compression method or encryption the libraries cannot read."""
+
+
+# Error kinds sent by the extraction workers, and what the bot raises for them
+ARCHIVE_ERRORS = {"wrong_password": WrongPassword, "unsupported": UnsupportedArchive}
+
+
+def queue_entry(entries, cancelled, entry):
+    """Put an entry on the bounded queue, blocking while it is full unless extraction was cancelled."""
+    while True:
         try:
-            if file_name.endswith('.zip'):
-                with zipfile.ZipFile(original_file_path) as archive:
-                    archive.setpassword(password.encode())
-                    archive.extractall(extracted_dir)
-            elif file_name.endswith('.rar'):
-                with rarfile.RarFile(original_file_path) as archive:
-                    archive.extractall(extracted_dir, pwd=password.encode())
-            elif file_name.endswith('.7z'):
-                with py7zr.SevenZipFile(original_file_path, mode='r') as archive:
-                    archive.extractall(extracted_dir, password=password)
-            elif file_name.endswith('.gz'):
-                output_file = context.user_data['output_file']
-                output_dir = context.user_data['output_dir']
-                with tarfile.open(output_file, 'r:gz', pwd=password.encode()) as tar:
-                    tar.extractall(output_dir)
-            await update.message.reply_text("Archive extracted successfully. Sending files...")
-            await send_extracted_files(update, context, extracted_dir)
-            return ConversationHandler.END
-        except RuntimeError as e:
-            if "Bad password" in str(e):
-                await update.message.reply_text("Incorrect password. Please try again.")
-                if attempt == retries - 1:
-                    await update.message.reply_text("Too many incorrect attempts. Operation cancelled.")
-                    return ConversationHandler.END
-                return WAITING_FOR_PASSWORD
+            entries.put(entry, timeout=1)
+            return
+        except queue.Full:
+            if cancelled.is_set():
+                raise ExtractionCancelled()
+
+
+class ProgressReporter:
+    """Queues ("progress", percent) entries from the extraction worker in 10% steps."""
+
+    def __init__(self, put, total):
+        self.put = put
+        self.total = total
+        self.last_reported = 0
+
+    def update(self, done):
+        if not self.total:
+            return
+        rounded_progress = int(done * 100 / self.total // 10 * 10)  # Round down to the nearest 10%
+        if self.last_reported < rounded_progress < 100:
+            self.last_reported = rounded_progress
+            self.put(("progress", rounded_progress))
+
+
+def needs_password(file_path: str) -> bool:
+    """Check whether an archive is password-protected. Runs in the extraction pool.
+
+    Only the archive headers are read; nothing is decompressed. CRCs are checked
+    later, while the members are extracted.
+    """
+    if file_path.endswith('.zip'):
+        with zipfile.ZipFile(file_path) as archive:
+            # Bit 0 of a member's general purpose flags marks it as encrypted
+            return any(info.flag_bits & ZIP_ENCRYPTED_FLAG for info in archive.infolist())
+    elif file_path.endswith('.rar'):
+        with rarfile.RarFile(file_path) as archive:
+            return archive.needs_password()
+    elif file_path.endswith('.7z'):
+        try:
+            with py7zr.SevenZipFile(file_path, mode='r') as archive:
+                return archive.needs_password()
+        except py7zr.exceptions.PasswordRequired:
+            return True  # The headers themselves are encrypted
+    # GZ files have no password support
+    return False
+
+
+def check_password(file_path: str, password: str) -> bool:
+    """Check a password by decrypting only the cheapest encrypted member. Runs in the extraction pool.
+
+    The member is read in full so its CRC is checked too; the quick check values
+    in zip headers alone let roughly one wrong password in 256 through.
+    """
+    try:
+        if file_path.endswith('.zip'):
+            with zipfile.ZipFile(file_path) as archive:
+                encrypted = [info for info in archive.infolist() if info.flag_bits & ZIP_ENCRYPTED_FLAG]
+                if encrypted:
+                    smallest = min(encrypted, key=lambda info: info.compress_size)
+                    with archive.open(smallest, pwd=password.encode()) as member:
+                        while member.read(COPY_BUFFER_SIZE):
+                            pass
+        elif file_path.endswith('.rar'):
+            with rarfile.RarFile(file_path) as archive:
+                archive.setpassword(password)  # Archives with encrypted headers are parsed again here
+                encrypted = [info for info in archive.infolist() if not info.is_dir() and info.needs_password()]
+                if encrypted:
+                    smallest = min(encrypted, key=lambda info: info.compress_size)
+                    with archive.open(smallest) as member:
+                        while member.read(COPY_BUFFER_SIZE):
+                            pass
+        elif file_path.endswith('.7z'):
+            with py7zr.SevenZipFile(file_path, mode='r', password=password) as archive:
+                # In a solid folder everything before a file has to be decompressed too, so count that in
+                cost, folder, cheapest = 0, None, None
+                for member in archive.files:
+                    if member.is_directory:
+                        continue
+                    cost = cost + member.uncompressed if member.folder is folder else member.uncompressed
+                    folder = member.folder
+                    if cheapest is None or cost < cheapest[0]:
+                        cheapest = (cost, member.filename)
+                if cheapest:
+                    archive.read(targets=[cheapest[1]])
+    except Exception as e:
+        if is_unsupported(e):
+            raise UnsupportedArchive(str(e) or type(e).__name__)
+        # Nothing is written to disk here, so an OSError can only come from a decompressor (bz2 raises those)
+        if not (is_wrong_password(file_path, password, e) or isinstance(e, OSError) and not file_path.endswith('.rar')):
+            raise
+        logging.info(f"Password check for {file_path} failed: {e!r}")
+        return False
+    return True
+
+
+def is_wrong_password(file_path: str, password: str, e: Exception) -> bool:
+    """Whether e, raised while decrypting file_path with password, means the password is wrong.
+
+    A wrong key turns the data into garbage, which the decompressors mostly
+    report as corrupt data rather than as a bad password.
+    """
+    if password is None or is_unsupported(e):
+        return False
+    if file_path.endswith('.zip'):
+        return isinstance(e, (RuntimeError, zipfile.BadZipFile, zlib.error, lzma.LZMAError, EOFError))
+    if file_path.endswith('.rar'):
+        return isinstance(e, (rarfile.RarWrongPassword, rarfile.RarCRCError, rarfile.BadRarFile))
+    if file_path.endswith('.7z'):
+        # py7zr reports garbage in many different ways (even TypeError from a garbled header), so all but
+        # disk and memory errors count; a corrupt archive cannot be told apart from a wrong key here
+        return not isinstance(e, (OSError, MemoryError))
+    return False
+
+
+def is_unsupported(e: Exception) -> bool:
+    """Whether e says the archive uses a method the libraries cannot decompress or decrypt, such as deflate64 or WinZip AES."""
+    return isinstance(e, (NotImplementedError, py7zr.exceptions.UnsupportedCompressionMethodError))
+
+
+def error_kind(file_path: str, password: str, e: Exception):
+    """Classify an extraction error as one of the ARCHIVE_ERRORS kinds, or None for any other failure."""
+    if is_unsupported(e):
+        return "unsupported"
+    if is_wrong_password(file_path, password, e):
+        return "wrong_password"
+    return None
+
+
+def list_members(file_path: str, password: str = None):
+    """List the (name, uncompressed size) of every file in an archive from its headers. Runs in the extraction pool.
+
+    Returns None for tarballs, whose contents are only known by decompressing them.
+    """
+    if file_path.endswith('.zip'):
+        with zipfile.ZipFile(file_path) as archive:
+            members = [(info.filename, info.file_size) for info in archive.infolist() if not info.is_dir()]
+    elif file_path.endswith('.rar'):
+        with rarfile.RarFile(file_path) as archive:
+            if password:
+                archive.setpassword(password)
+            members = [(info.filename, info.file_size) for info in archive.infolist() if not info.is_dir()]
+    elif file_path.endswith('.7z'):
+        with py7zr.SevenZipFile(file_path, mode='r', password=password) as archive:
+            members = [(member.filename, member.uncompressed) for member in archive.files if not member.is_directory]
+    elif file_path.endswith('.gz'):
+        if tarfile.is_tarfile(file_path):
+            return None
+        members = [(gzip_output_name(file_path), gzip_size(file_path))]
+    else:
+        raise RuntimeError("Unsupported file format.")
+    return [(name, size) for name, size in members if not is_hidden(name)]
+
+
+def gzip_output_name(file_path):
+    return os.path.splitext(os.path.basename(file_path))[0]  # Remove .gz extension
+
+
+def gzip_size(file_path):
+    """Uncompressed size from the gzip trailer (modulo 4 GB, as the format stores it)."""
+    with open(file_path, 'rb') as gz_file:
+        gz_file.seek(-4, os.SEEK_END)
+        return int.from_bytes(gz_file.read(4), 'little')
+
+
+def is_hidden(member_name):
+    """Return True if any component of an archive member name starts with a dot."""
+    return any(part.startswith('.') for part in member_name.replace('\\', '/').split('/') if part)
+
+
+def member_output_path(output_dir, member_name):
+    """Map an archive member name to a path inside output_dir, or None if it would escape it."""
+    output_dir = os.path.abspath(output_dir)
+    path = os.path.normpath(os.path.join(output_dir, member_name.replace('\\', '/').lstrip('/')))
+    if os.path.commonpath([output_dir, path]) != output_dir or path == output_dir:
+        return None
+    return path
+
+
+def write_member(source, file_path):
+    """Copy an open archive member to file_path, returning the SHA-256 of its contents."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    digest = hashlib.sha256()
+    with open(file_path, 'wb') as out_file:
+        while chunk := source.read(COPY_BUFFER_SIZE):
+            digest.update(chunk)
+            out_file.write(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(file_path):
+    """SHA-256 of a file already on disk."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(COPY_BUFFER_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_entries(file_path: str, output_dir: str, password: str, file_filter, entries, cancelled):
+    """Extract an archive member by member, queueing each finished file for sending.
+
+    Only members accepted by file_filter (a FileFilter, or None for all) are
+    decompressed. Runs in the extraction process pool, so entries and cancelled
+    are manager proxies. Always finishes by queueing either ("done",) or
+    ("error", message, kind), where kind is a key of ARCHIVE_ERRORS or None.
+    On success, returns the seconds spent extracting (not counting time blocked
+    on a full queue) and the bytes written.
+    """
+    started = time.monotonic()
+    blocked = 0.0
+    bytes_out = 0
+
+    def put(entry):
+        nonlocal blocked, bytes_out
+        if entry[0] == "file":
+            bytes_out += os.path.getsize(entry[1])
+        waiting_since = time.monotonic()
+        queue_entry(entries, cancelled, entry)
+        blocked += time.monotonic() - waiting_since
+
+    try:
+        if file_path.endswith('.zip'):
+            extract_zip(file_path, output_dir, password, file_filter, put)
+        elif file_path.endswith('.rar'):
+            extract_rar(file_path, output_dir, password, file_filter, put)
+        elif file_path.endswith('.7z'):
+            extract_7z(file_path, output_dir, password, file_filter, put)
+        elif file_path.endswith('.gz'):
+            extract_gzip(file_path, output_dir, file_filter, put)
+        else:
+            raise RuntimeError("Unsupported file format.")
+    except ExtractionCancelled:
+        return
+    except Exception as e:
+        logging.error(f"An error occurred while extracting {file_path}: {e}")
+        try:
+            put(("error", str(e) or type(e).__name__, error_kind(file_path, password, e)))
+        except ExtractionCancelled:
+            pass
+        return
+    busy_seconds = time.monotonic() - started - blocked
+    try:
+        put(("done",))
+    except ExtractionCancelled:
+        pass
+    return busy_seconds, bytes_out
+
+
+def extract_zip(file_path, output_dir, password, file_filter, put):
+    """Extract .zip files one member at a time."""
+    with zipfile.ZipFile(file_path) as archive:
+        if password:
+            archive.setpassword(password.encode())
+        members = [info for info in archive.infolist() if not file_filter or file_filter.matches(info.filename, info.file_size)]
+        progress = ProgressReporter(put, sum(info.file_size for info in members))
+        done = 0
+        for info in members:
+            done += info.file_size
+            output_file = member_output_path(output_dir, info.filename)
+            if info.is_dir() or is_hidden(info.filename) or output_file is None:
+                continue
+            with archive.open(info) as member:
+                digest = write_member(member, output_file)
+            put(("file", output_file, digest))
+            progress.update(done)
+
+
+def extract_rar(file_path, output_dir, password, file_filter, put):
+    """Extract .rar files one member at a time.
+
+    rarfile starts unrar again for every member of a solid archive, and each run
+    decompresses the solid stream from the start. Solid archives are therefore
+    streamed through a single unrar run instead, see extract_solid_rar().
+    """
+    with rarfile.RarFile(file_path) as archive:
+        if password:
+            archive.setpassword(password)
+        members = [info for info in archive.infolist() if not file_filter or file_filter.matches(info.filename, info.file_size)]
+        progress = ProgressReporter(put, sum(info.file_size for info in members))
+        # Links and file copies have no data of their own in the stream, so their sizes would not add up
+        if archive.is_solid() and not any(info.is_symlink() or info.file_redir for info in archive.infolist()):
+            extract_solid_rar(archive, file_path, output_dir, password, members, put, progress)
+            return
+        done = 0
+        for info in members:
+            done += info.file_size
+            output_file = member_output_path(output_dir, info.filename)
+            if info.is_dir() or is_hidden(info.filename) or output_file is None:
+                continue
+            with archive.open(info) as member:
+                digest = write_member(member, output_file)
+            put(("file", output_file, digest))
+            progress.update(done)
+
+
+def extract_solid_rar(archive, file_path, output_dir, password, members, put, progress):
+    """Extract a solid .rar in one pass, cutting the stream of all its files into members by their sizes.
+
+    Without a file name, unrar's "p" command writes every file of the archive to
+    stdout in archive order. Members that were filtered out are read and dropped,
+    as the solid stream has to be decompressed through them anyway. The pipe
+    blocks while the queue is full, so unrar never runs ahead of the uploads.
+    """
+    setup = rarfile.tool_setup()
+    wanted = set(members)
+    done = 0
+    process = subprocess.Popen(setup.open_cmdline(password, file_path), stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            member = SolidRarMember(process.stdout, info)
+            output_file = member_output_path(output_dir, info.filename)
+            if info not in wanted or is_hidden(info.filename) or output_file is None:
+                while member.read(COPY_BUFFER_SIZE):
+                    pass
+                continue
+            digest = write_member(member, output_file)
+            done += info.file_size
+            put(("file", output_file, digest))
+            progress.update(done)
+        process.stdout.read()  # Nothing should be left, but unrar only exits once its output is read
+        process.wait()
+    except rarfile.BadRarFile:
+        # The stream ended early, so unrar has exited and its status says why (e.g. a wrong password)
+        rarfile.check_returncode(process.wait(), "", setup.get_errmap())
+        raise
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    rarfile.check_returncode(process.returncode, "", setup.get_errmap())
+
+
+class SolidRarMember:
+    """One member's share of the unrar output stream, checked against the member's CRC."""
+
+    def __init__(self, stream, info):
+        self.stream = stream
+        self.info = info
+        self.remaining = info.file_size
+        self.crc = 0
+
+    def read(self, size):
+        if not self.remaining:
+            return b""
+        data = self.stream.read(min(size, self.remaining))
+        if not data:
+            raise rarfile.BadRarFile(f"Unexpected end of data in {self.info.filename}")
+        self.remaining -= len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        # RAR5 archives may carry a BLAKE2 hash instead of a CRC
+        if not self.remaining and self.info.CRC is not None and self.crc != self.info.CRC:
+            raise rarfile.RarCRCError(f"CRC error in {self.info.filename}")
+        return data
+
+
+def extract_7z(file_path, output_dir, password, file_filter, put):
+    """Extract .7z files one folder (solid block) at a time.
+
+    py7zr can only decompress a whole folder in one go, so every folder is
+    extracted with its own extract() call and its files are queued together.
+    Non-solid archives therefore stream file by file.
+    """
+    with py7zr.SevenZipFile(file_path, mode='r', password=password) as archive:
+        folders = []
+        for member in archive.files:
+            if member.is_directory or is_hidden(member.filename) or member_output_path(output_dir, member.filename) is None:
+                continue
+            if file_filter and not file_filter.matches(member.filename, member.uncompressed):
+                continue
+            if folders and folders[-1][0] is member.folder:
+                folders[-1][1].append(member)
             else:
-                await update.message.reply_text(f"Failed to extract archive: {e}")
-                return ConversationHandler.END   
-        finally:
-            cleanup(original_file_path, extracted_dir) 
-    return ConversationHandler.END
+                folders.append((member.folder, [member]))
+        progress = ProgressReporter(put, sum(member.uncompressed for _, members in folders for member in members))
+        done = 0
+        for _, members in folders:
+            archive.reset()
+            archive.extract(path=output_dir, targets=[member.filename for member in members])
+            for member in members:
+                done += member.uncompressed
+                output_file = member_output_path(output_dir, member.filename)
+                if os.path.isfile(output_file):
+                    # py7zr writes the files itself, so they are hashed while still in the page cache
+                    put(("file", output_file, file_digest(output_file)))
+            progress.update(done)
 
-async def cancel(update: Update, context: CallbackContext) -> int:
-    """Cancel the conversation."""
-    await update.message.reply_text("Operation cancelled.", reply_markup=ReplyKeyboardRemove())
-    return ConversationHandler.END
+
+def extract_gzip(file_path: str, output_dir: str, file_filter, put) -> None:
+    """Extract .gz files.
+
+    Decompression is streamed in COPY_BUFFER_SIZE chunks. Tarballs are read
+    straight out of the gzip stream, so no intermediate .tar is written.
+    """
+    # Only the first header is decompressed to tell a tarball from a plain .gz
+    if not tarfile.is_tarfile(file_path):
+        output_name = gzip_output_name(file_path)
+        if file_filter and not file_filter.matches(output_name, gzip_size(file_path)):
+            return
+        output_file = os.path.join(output_dir, output_name)
+        with gzip.open(file_path, 'rb') as gz_file:
+            digest = write_member(gz_file, output_file)
+        put(("file", output_file, digest))
+        return
+
+    # Progress follows the position in the compressed file, since the unpacked size is unknown up front
+    progress = ProgressReporter(put, os.path.getsize(file_path))
+    with open(file_path, 'rb') as raw_file, tarfile.open(fileobj=raw_file, mode='r|gz', bufsize=COPY_BUFFER_SIZE) as tar:
+        for member in tar:
+            member_file = member_output_path(output_dir, member.name)
+            if not member.isfile() or is_hidden(member.name) or member_file is None:
+                continue
+            if file_filter and not file_filter.matches(member.name, member.size):
+                continue  # Skipped members are read past without being written
+            with tar.extractfile(member) as source:
+                digest = write_member(source, member_file)
+            put(("file", member_file, digest))
+            progress.update(raw_file.tell())
+
+
+async def ask(job: Job, question: str, timeout: float, **kwargs) -> str:
+    """Send the user a question about their archive and wait until receive_answer delivers the reply.
+
+    The job gives up its active slot while it waits. Returns None if the user
+    cancels, and raises asyncio.TimeoutError if there is no answer within timeout.
+    """
+    job.answer = asyncio.get_running_loop().create_future()
+    pending_questions.setdefault(job.user_id, []).append(job)
+    try:
+        await job.reply(question, **kwargs)
+        async with job_scheduler.suspended(job):
+            return await asyncio.wait_for(job.answer, timeout)
+    finally:
+        pending_questions[job.user_id].remove(job)
+        if not pending_questions[job.user_id]:
+            del pending_questions[job.user_id]
+
+
+async def ask_for_password(job: Job) -> str:
+    """Prompt the user for a password. Returns None if they cancel or do not answer within PASSWORD_TIMEOUT."""
+    try:
+        return await ask(job, f"{job.file_name} is password-protected. Please provide the password:", PASSWORD_TIMEOUT)
+    except asyncio.TimeoutError:
+        await job.reply(f"No password received for {job.file_name}.")
+        return None
+
+
+def manifest_summary(job: Job, members) -> str:
+    """Describe an archive's contents, e.g. "x.zip: 120 files, 1.4 GB unpacked (100 photos, 20 other files)"."""
+    if members is None:
+        return f"{job.file_name}: the contents of tar archives are only known once they are unpacked."
+    types = collections.Counter(media_type(name) or "other" for name, _ in members)
+    kinds = ", ".join(f"{types[kind]} {kind} files" for kind in ("photo", "video", "audio", "other") if types[kind])
+    total = sum(size for _, size in members)
+    return f"{job.file_name}: {len(members)} files, {format_size(total)} unpacked ({kinds or 'empty'})."
+
+
+async def choose_files(job: Job, password: str = None) -> bool:
+    """List the archive, show a summary and settle job.file_filter before anything is decompressed.
+
+    The filter comes from the archive's caption, or else from a question asked
+    for archives with at least FILTER_PROMPT_MIN_FILES files. Returns False if
+    the job should stop: the user cancelled or nothing matched.
+    """
+    async with job_scheduler.extraction_slots:
+        with metrics.timer("listing", job.archive_format):
+            members = await run_extraction_job(list_members, job.original_file_path, password)
+    await job.reply(manifest_summary(job, members))
+    if members is None:
+        return True
+
+    if not job.filter_chosen and FILTER_TIMEOUT and len(members) >= FILTER_PROMPT_MIN_FILES:
+        keyboard = ReplyKeyboardMarkup([["All files", "Media only"]], one_time_keyboard=True, resize_keyboard=True)
+        try:
+            answer = await ask(job, "Which files do you want? Pick one below, or send a filter such as "
+                                    "\"*.pdf\", \"photos/*\" or \"<20MB\" (terms can be combined).",
+                               FILTER_TIMEOUT, reply_markup=keyboard)
+        except asyncio.TimeoutError:
+            answer = "all"
+        if answer is None:
+            return False
+        job.file_filter = FileFilter.parse(answer)
+        job.filter_chosen = True
+        if job_journal:
+            job_journal.update(job)
+
+    if job.file_filter:
+        selected = [(name, size) for name, size in members if job.file_filter.matches(name, size)]
+        metrics.count("filtered_jobs", format=job.archive_format)
+        if not selected:
+            await job.reply(f"No files match {job.file_filter}.", reply_markup=ReplyKeyboardRemove())
+            return False
+        await job.reply(f"Sending {len(selected)} of {len(members)} files ({format_size(sum(size for _, size in selected))}) "
+                        f"matching {job.file_filter}.", reply_markup=ReplyKeyboardRemove())
+    else:
+        await job.reply("Sending all files.", reply_markup=ReplyKeyboardRemove())
+    return True
+
+
+async def extract_with_password(job: Job) -> None:
+    """Ask for the password of a protected archive and extract it, allowing a few attempts.
+
+    Each password is tried on a single small member first, so a wrong one is
+    rejected without extracting anything. The archive stays on disk until the
+    last attempt.
+    """
+    retries = 3
+    for attempt in range(retries):
+        password = await ask_for_password(job)
+        if password is None:
+            await job.reply("Operation cancelled.")
+            return
+        job.password = password
+        async with job_scheduler.extraction_slots:
+            with metrics.timer("password_check", job.archive_format):
+                password_correct = await run_extraction_job(check_password, job.original_file_path, password)
+        if password_correct:
+            if not await choose_files(job, password):
+                return
+            try:
+                await job.reply("Password received. Extracting and sending files...")
+                await send_extracted_files(job, password)
+                return
+            except WrongPassword:
+                pass
+        metrics.count("wrong_passwords", format=job.archive_format)
+        if attempt == retries - 1:
+            await job.reply("Too many incorrect attempts. Operation cancelled.")
+            return
+        await job.reply("Incorrect password. Please try again.")
+
+
+async def receive_answer(update: Update, context: CallbackContext) -> None:
+    """Hand a text message from the user to their oldest archive that is waiting for an answer."""
+    waiting_jobs = pending_questions.get(update.message.from_user.id)
+    if not waiting_jobs:
+        return
+    job = waiting_jobs[0]
+    if not job.answer.done():
+        metrics.count("answers_received")
+        job.answer.set_result(update.message.text)
+
+
+async def cancel(update: Update, context: CallbackContext) -> None:
+    """Cancel every archive of the user that is waiting for a password or a filter."""
+    requester_id = update.message.from_user.id
+    if requester_id not in ALLOWED_USERS:
+        return
+    for job in pending_questions.get(requester_id, []):
+        if not job.answer.done():
+            job.answer.set_result(None)
+    try:
+        await update.message.reply_text("Operation cancelled.", reply_markup=ReplyKeyboardRemove())
+    except Exception as e:
+        logging.error(f"An error occurred in cancel: {e}")
 
 
 async def handle_file_loop(update: Update, context: CallbackContext) -> None:
-    return asyncio.create_task(handle_file(update, context))
+    """Check an incoming archive and queue it as a job."""
+    requester_id = update.message.from_user.id
+    if requester_id not in ALLOWED_USERS:
+        return
+
+    file = update.message.document
+    if not file:
+        try:
+            await update.message.reply_text("Please send a valid compressed file (.zip, .rar, .7z, .gz).")
+        except Exception as e:
+            logging.error(f"An error occurred while replying: {e}")
+        return
 
+    if not (file.file_name.endswith(('.zip', '.rar', '.7z', '.gz'))):
+        try:
+            await update.message.reply_text("Only .zip, .rar, .7z, or .gz files are supported.")
+        except Exception as e:
+            logging.error(f"An error occurred while replying: {e}")
+        return
+
+    job = Job.from_message(update.message)
+    # The same document was unpacked before, so its results can be re-sent without queueing any work
+    if archive_cache and not job.file_filter and await send_cached_archive(job):
+        return
+    if job_journal:
+        job_journal.add(job)
+    # Application.stop() waits for handlers to return, so the job must not run inside this one
+    job_scheduler.start(job)
+
+
+async def resume_jobs(application: Application) -> None:
+    """Queue the jobs that were still unfinished when the bot last stopped."""
+    if not job_journal:
+        return
+    for job in job_journal.unfinished():
+        if job.resumes > JOURNAL_MAX_RESUMES:
+            logging.warning(f"Giving up on {job.file_name}, it was already resumed {JOURNAL_MAX_RESUMES} times")
+            job_journal.finish(job)
+            cleanup(job)
+            try:
+                await job.reply(f"{job.file_name} was interrupted too many times and has been cancelled. Please send it again.")
+            except Exception as e:
+                logging.error(f"An error occurred while replying: {e}")
+            continue
+        logging.info(f"Resuming job for {job.file_name} of user {job.user_id}")
+        job_scheduler.start(job)
+
+
+async def post_init(application: Application) -> None:
+    await export_metrics(application)
+    await resume_jobs(application)
+
+
+async def post_stop(application: Application) -> None:
+    # Interrupted jobs stay in the journal, to be resumed by the next run
+    await job_scheduler.shutdown()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+
+
+def start_services():
+    """Create the extraction pool, rate limiter, caches and job scheduler that the handlers use."""
+
+    global extraction_manager
+    global send_limiter
+    global file_id_cache
+    global archive_cache
+    global job_journal
+    global job_scheduler
+
+    if JOB_JOURNAL:
+        job_journal = JobJournal(JOURNAL_DB)
+    if RAM_TEMP_DIR:
+        os.makedirs(RAM_TEMP_DIR, exist_ok=True)
+    sweep_workspaces(job_journal.workspaces() if job_journal else ())
+
+    start_extraction_pool()
+    extraction_manager = extraction_context.Manager()
+    send_limiter = TokenBucket(SEND_RATE, SEND_BURST)
+    if FILE_ID_CACHE_SIZE:
+        file_id_cache = FileIdCache(CACHE_DB, FILE_ID_CACHE_SIZE)
+    if ARCHIVE_CACHE_SIZE:
+        archive_cache = ArchiveCache(CACHE_DB, ARCHIVE_CACHE_SIZE, ARCHIVE_CACHE_TTL)
+    job_scheduler = JobScheduler()
+
+
+def stop_services():
+    extraction_pool.shutdown(cancel_futures=True)
+    extraction_manager.shutdown()
 
 
 def main():
@@ -381,20 +2229,17 @@ def main():
     global app
     global telethon
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    configure_logging()
+    start_services()
 
-    app.add_handler(CommandHandler("start", start))
-    # app.add_handler(MessageHandler(filters.ATTACHMENT, handle_file))
-
-    conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.ATTACHMENT, handle_file_loop)],
-        states={
-            WAITING_FOR_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_password)],
-        },
-        fallbacks=[CommandHandler('cancel', cancel)],
-    )
+    app = Application.builder().token(BOT_TOKEN).post_init(post_init).post_stop(post_stop).build()
 
-    app.add_handler(conv_handler)
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler('cancel', cancel))
+    app.add_handler(CommandHandler("stats", stats))
+    # Jobs run for a long time, so attachments are handled without blocking other updates
+    app.add_handler(MessageHandler(filters.ATTACHMENT, handle_file_loop, block=False))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, receive_answer))
 
     try:
         if not API_ID and API_HASH:
@@ -405,6 +2250,8 @@ def main():
         app.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
         print(e)
+    finally:
+        stop_services()
 
 if __name__ == "__main__":
     main()